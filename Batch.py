@@ -0,0 +1,191 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# Generates many trees at once, spreading the jobs over a pool of processes.
+#
+# Each job names a rule, a seed and the BuildTree options to use, and is derived, interpreted and
+# exported in a worker process. The output file of a job only depends on the job itself,
+# so running the same batch twice writes the same files.
+#
+# To generate a batch from the command line:
+# - python Batch.py \<rule name\>... [--seeds N...] [--exporter E] [--workers W] [--out DIR] [options]
+# - E.g. python Batch.py "3D Birds Nest" TwoDTree4 --seeds 1 2 3 --stochastic --exporter table --out forest
+#
+
+from __future__ import division
+
+import os
+import io
+import re
+import sys
+import time
+import json
+import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from BuildTree import BuildTree
+from Rules import Rules
+
+## BuildTree setter of each job option.
+OPTIONS = {"stochastic": "useStochastic",
+		   "spheres": "useSpheres",
+		   "base": "useBase",
+		   "merge": "useMerge",
+		   "batch": "useBatch",
+		   "streaming": "useStreaming",
+		   "exporter": "setExporter",
+		   "lod": "setLod",
+		   "voxel": "setVoxel",
+		   "pruneDepth": "setPruneDepth",
+		   "encoded": "useEncoded",
+		   "spill": "setSpill"}
+
+## BuildTree attribute of each job option without a setter.
+ATTRIBUTES = {"axis": "axis", "diameter": "diameter"}
+
+## A tree to generate: a rule, a seed and the options of the BuildTree.
+#
+#  Example usage:
+#  - Job("3D Birds Nest", 7, {"stochastic": True, "axis": "+Z", "exporter": "table"})
+class Job(object):
+
+	## Constructor.
+	#  @param ruleName key of Rules.fetchRules.
+	#  @param seed seed of the random generators.
+	#  @param options dictionary with keys of OPTIONS or ATTRIBUTES.
+	def __init__(self, ruleName, seed=0, options=None):
+		self.ruleName = ruleName
+		self.seed = seed
+		self.options = dict(options or {})
+		for key in self.options:
+			if key not in OPTIONS and key not in ATTRIBUTES:
+				raise ValueError("Unknown job option: %s" % key)
+
+	## Return the name of the output file, without its extension.
+	#  @param index position of the job in the batch.
+	def name(self, index):
+		rule = re.sub(r"[^A-Za-z0-9]+", "_", self.ruleName).strip("_")
+		return "%04d_%s_s%d" % (index, rule, self.seed)
+
+	## Return a BuildTree configured with the options of the job.
+	def builder(self):
+		tree = BuildTree()
+		for key, value in sorted(self.options.items()):
+			if key in OPTIONS:
+				getattr(tree, OPTIONS[key])(value)
+			else:
+				setattr(tree, ATTRIBUTES[key], value)
+		return tree
+
+## Generate the tree of a job and return a summary of the work done.
+#  Runs in a worker process.
+#  @param index position of the job in the batch.
+#  @param job a Job.
+#  @param directory directory the file is written to.
+#  @param verbose whether to keep the log printed while the tree is generated.
+#  @return a dictionary with the index, path, size, seconds and process id.
+def runJob(index, job, directory, verbose=False):
+	start = time.time()
+	tree = job.builder()
+	tree.seed(job.seed)
+	rule = tree.rules.fetchRules()[job.ruleName]
+	filepath = os.path.join(directory, job.name(index) + tree.extension())
+	log = io.StringIO()
+	with contextlib.redirect_stdout(sys.stdout if verbose else log):
+		tree.checkBudget(rule)
+		tree.export(rule, filepath)
+
+	return {"index": index, "path": filepath, "bytes": os.path.getsize(filepath),
+			"seconds": time.time() - start, "pid": os.getpid()}
+
+## Generate the trees of a list of jobs in a pool of processes.
+#  @param jobs list of Job objects.
+#  @param directory directory the files are written to, created if needed.
+#  @param workers number of processes, or None to use every core.
+#  @param verbose whether to print the log of every tree.
+#  @return the list of job summaries, in the order of the jobs, and the elapsed wall time.
+def runBatch(jobs, directory=".", workers=None, verbose=False):
+	rules = Rules().fetchRules()
+	for job in jobs:
+		if job.ruleName not in rules:
+			raise ValueError("Unknown rule: %s" % job.ruleName)
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+
+	start = time.time()
+	results = [None] * len(jobs)
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		futures = [pool.submit(runJob, i, job, directory, verbose) for i, job in enumerate(jobs)]
+		for future in as_completed(futures):
+			result = future.result()
+			results[result["index"]] = result
+			print("%-40s %8.3fs %12d bytes" % (result["path"], result["seconds"], result["bytes"]))
+	return results, time.time() - start
+
+## Print the throughput of every worker and of the whole batch.
+#  @param results job summaries returned by runBatch.
+#  @param seconds elapsed wall time of the batch.
+def summary(results, seconds):
+	workers = {}
+	for result in results:
+		jobs, busy, size = workers.get(result["pid"], (0, 0.0, 0))
+		workers[result["pid"]] = (jobs + 1, busy + result["seconds"], size + result["bytes"])
+
+	print("")
+	print("%-10s %6s %10s %10s %14s" % ("worker", "jobs", "busy", "jobs/s", "bytes/s"))
+	for pid, (jobs, busy, size) in sorted(workers.items()):
+		print("%-10d %6d %9.3fs %10.3f %14.0f" % (pid, jobs, busy, jobs / busy if busy > 0 else 0, size / busy if busy > 0 else 0))
+	total = sum(result["bytes"] for result in results)
+	rate = len(results) / seconds if seconds > 0 else 0
+	print("%d trees, %d bytes in %.3fs -> %.3f trees/s with %d workers" % (len(results), total, seconds, rate, len(workers)))
+
+## Return the jobs described by the command line arguments.
+#  The jobs of a json file are lists [rule name, seed, options].
+def parseJobs(args):
+	if args.jobs is not None:
+		with open(args.jobs) as f:
+			return [Job(*entry) for entry in json.load(f)]
+
+	options = {"axis": args.axis, "diameter": args.diameter, "exporter": args.exporter, "batch": True}
+	for key in ("stochastic", "spheres", "base", "merge"):
+		if getattr(args, key):
+			options[key] = True
+	if args.lod is not None:
+		options["lod"] = args.lod
+	return [Job(ruleName, seed, options) for ruleName in args.rules for seed in args.seeds]
+
+## Main program for batch generation.
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Generate many trees in parallel.")
+	parser.add_argument("rules", nargs="*", help="rule names, see Rules.fetchRules")
+	parser.add_argument("--seeds", nargs="+", type=int, default=[0], help="one tree per rule and seed")
+	parser.add_argument("--jobs", help="json file with a list of [rule name, seed, options] jobs")
+	parser.add_argument("--exporter", default="stream", help="see BuildTree.setExporter")
+	parser.add_argument("--axis", default="+X", choices=["+X", "+Y", "+Z", "-X", "-Y", "-Z"])
+	parser.add_argument("--diameter", type=float, default=6, help="diameter of the base")
+	parser.add_argument("--lod", help="level of detail, see LOD.LEVELS")
+	parser.add_argument("--stochastic", action="store_true", help="use the stochastic rules")
+	parser.add_argument("--spheres", action="store_true", help="add spheres between the cylinders")
+	parser.add_argument("--base", action="store_true", help="add a base to the trees")
+	parser.add_argument("--merge", action="store_true", help="fuse collinear cylinders")
+	parser.add_argument("--workers", type=int, help="number of processes, every core by default")
+	parser.add_argument("--out", default=".", help="output directory")
+	parser.add_argument("--verbose", action="store_true", help="print the log of every tree")
+	args = parser.parse_args(argv)
+
+	if not args.rules and args.jobs is None:
+		parser.error("give at least one rule name or a --jobs file")
+	try:
+		jobs = parseJobs(args)
+		results, seconds = runBatch(jobs, args.out, args.workers, args.verbose)
+	except ValueError as e:
+		print(e)
+		return 1
+	summary(results, seconds)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,201 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# A turtle backend that interprets a whole compiled program at once with NumPy.
+#
+# Every opcode is turned into a local 4x4 transform (a rotation about one of the intrinsic axes,
+# a step forward, or the identity). The state after an opcode is the state after its parent times its
+# local transform, where the parent of an opcode is the previous one, except for a pop, whose parent is
+# the matching push. The states of all opcodes are then computed by pointer jumping: at each pass every
+# opcode multiplies in the accumulated transform of its current ancestor and jumps to the ancestor's ancestor,
+# so the number of passes is logarithmic in the depth of the program.
+#
+
+import random
+import numpy as np
+import matrix
+from Compiler import FORWARD, YAW, PITCH, ROLL, POP, RADIUS, LEAF, LEAF_RADIUS
+from turtle import colors
+from SegmentStore import SegmentStore
+from Brackets import BracketIndex
+
+## Rotation axis of each rotation opcode.
+AXES = {YAW: (0, 0, 1), PITCH: (0, 1, 0), ROLL: (1, 0, 0)}
+
+## Colors used by the turtle when no pen color is set, indexed by the last rotation opcode.
+AXIS_COLORS = {YAW: "blue", PITCH: "green", ROLL: "red"}
+
+## Colors randomly chosen for the flowers.
+LEAF_COLORS = ["medium orchid", "magenta", "pastel pink", "orange red", "cyan"]
+
+## Return the opcode arrays of a compiled program.
+#  @param program - a tuple (ops, args) returned by Compiler.compileSentence
+def programArrays(program):
+	ops, args = program
+	if isinstance(ops, (bytes, bytearray)) or hasattr(ops, "typecode"):
+		ops = np.frombuffer(ops, dtype=np.uint8)
+	else:
+		ops = np.asarray(ops, dtype=np.uint8)
+	args = np.asarray(args, dtype=float)
+	return ops, args
+
+## Return, for every pop of the program, the index of the matching push.
+#  Pushes that are never popped are ignored. A pop without a push raises a ValueError.
+#  @param ops - opcode array
+#  @return a tuple (pushes, pops) of index arrays, where pushes[i] matches pops[i]
+#  @see Brackets.BracketIndex
+def matchBrackets(ops):
+	index = BracketIndex(ops)
+	return index.pushes, index.pops
+
+## Interprets a compiled program, producing the transform of every cylinder and flower.
+#
+#  Example usage:
+#  - b = BatchTurtle()
+#  - b.run(compileSentence(sentence, angle), 4)
+#  - b.store.transforms()  -> (N,4,4) array with the transform of each node
+class BatchTurtle(object):
+
+	## Constructor.
+	#  @param r initial cylinder radius.
+	#  @param col pen color name, or None to use the turtle default colors.
+	#  @param rounded whether to add spheres to the cylinders.
+	#  @param store SegmentStore the nodes are written into, or None to create a new one.
+	#  @param rng random number generator choosing the flower color, e.g. a random.Random.
+	def __init__(self, r=2, col=None, rounded=False, store=None, rng=None):
+		self.r = r
+		self.col = col
+		self.round = rounded
+		## Colors indexed by the color indices computed by nodeColors.
+		self.palette = []
+		## Color of the flowers.
+		self.leafCol = None
+		## Nodes computed so far.
+		self.store = store if store is not None else SegmentStore()
+		self.rng = rng if rng is not None else random
+
+	## Return the index of a color in the palette, adding it if needed.
+	def paletteIndex(self, c):
+		if c not in self.palette:
+			self.palette.append(c)
+		return self.palette.index(c)
+
+	## Return the local transform of every opcode.
+	#  @param ops - opcode array
+	#  @param args - argument array
+	#  @param d - length of each step
+	def localTransforms(self, ops, args, d):
+		local = np.empty((len(ops), 4, 4))
+		local[:] = np.identity(4)
+
+		forward = ops == FORWARD
+		local[forward, 0, 3] = d
+
+		# Build one rotation matrix per distinct (axis, angle) pair.
+		for op, axis in AXES.items():
+			selected = ops == op
+			if not selected.any():
+				continue
+			angles, inverse = np.unique(args[selected], return_inverse=True)
+			rotations = np.array([np.asarray(matrix.rotate(a, axis[0], axis[1], axis[2])) for a in angles])
+			local[selected] = rotations[inverse]
+		return local
+
+	## Return the state (transform and radius) after every opcode and the parent of every opcode.
+	#  @param ops - opcode array
+	#  @param args - argument array
+	#  @param d - length of each step
+	def states(self, ops, args, d):
+		n = len(ops)
+		parent = np.arange(-1, n - 1)
+		pushes, pops = matchBrackets(ops)
+		parent[pops] = pushes
+
+		acc = self.localTransforms(ops, args, d)
+		scale = np.where(ops == RADIUS, 1 + args, 1.0)
+		parentOf = parent.copy()
+
+		ancestor = parent.copy()
+		active = np.nonzero(ancestor >= 0)[0]
+		while len(active) > 0:
+			p = ancestor[active]
+			acc[active] = np.matmul(acc[p], acc[active])
+			scale[active] = scale[p] * scale[active]
+			ancestor[active] = ancestor[p]
+			active = active[ancestor[active] >= 0]
+		return acc, scale * self.r, parentOf
+
+	## Return the color index of every node, reproducing the colors the turtle would use.
+	#  @param ops - opcode array
+	#  @param nodes - indices of the nodes in the program
+	def nodeColors(self, ops, nodes):
+		if self.col is not None:
+			return np.full(len(nodes), self.paletteIndex(colors[self.col.lower()]), dtype=np.int32)
+
+		# Without a pen color, the color follows the axis of the last rotation,
+		# until the first pop sets it to pumpkin orange.
+		index = np.arange(len(ops))
+		isRot = (ops == YAW) | (ops == PITCH) | (ops == ROLL)
+		lastRot = np.maximum.accumulate(np.where(isRot, index, -1))[nodes]
+		lastOp = np.where(lastRot >= 0, ops[np.maximum(lastRot, 0)], YAW)
+
+		result = np.empty(len(nodes), dtype=np.int32)
+		for op, name in AXIS_COLORS.items():
+			result[lastOp == op] = self.paletteIndex(colors[name])
+		pops = np.nonzero(ops == POP)[0]
+		if len(pops) > 0:
+			result[nodes > pops[0]] = self.paletteIndex(colors["pumpkin orange"])
+		return result
+
+	## Return the nodes of a program with their transforms and radii.
+	#  @param ops - opcode array
+	#  @param args - argument array
+	#  @param d - length of each step
+	#  @return a tuple (nodes, transforms, radii, leaves): the opcode index, (N,4,4) transform, radius and leaf flag of each node
+	def nodeTransforms(self, ops, args, d):
+		acc, radii, parent = self.states(ops, args, d)
+		return self.place(ops, acc, radii, parent)
+
+	## Return the nodes of a program with their transforms and radii, given the states computed by states.
+	#  @see nodeTransforms
+	def place(self, ops, acc, radii, parent):
+		nodes = np.nonzero((ops == FORWARD) | (ops == LEAF))[0]
+		leaves = ops[nodes] == LEAF
+
+		# The node is drawn with the state before its opcode, i.e. the state after its parent.
+		before = parent[nodes]
+		transforms = np.empty((len(nodes), 4, 4))
+		transforms[:] = np.identity(4)
+		hasParent = before >= 0
+		transforms[hasParent] = acc[before[hasParent]]
+		nodeRadii = np.where(hasParent, radii[np.maximum(before, 0)], self.r)
+
+		# Move the initial cylinder to the x axis.
+		cylinders = ~leaves
+		transforms[cylinders] = np.matmul(transforms[cylinders], np.asarray(matrix.rotate(90, 0, 1, 0)))
+		nodeRadii[leaves] = LEAF_RADIUS
+		return nodes, transforms, nodeRadii, leaves
+
+	## Run a compiled program, adding its nodes to the store.
+	#  @param program - a tuple (ops, args) returned by Compiler.compileSentence
+	#  @param d - length of each step
+	def run(self, program, d):
+		ops, args = programArrays(program)
+		if len(ops) == 0:
+			return
+
+		nodes, transforms, nodeRadii, leaves = self.nodeTransforms(ops, args, d)
+		colorIndex = self.nodeColors(ops, nodes)
+		if leaves.any():
+			if self.leafCol is None:
+				self.leafCol = colors[self.rng.choice(LEAF_COLORS)]
+			colorIndex[leaves] = self.paletteIndex(self.leafCol)
+
+		self.store.extend(transforms, nodeRadii, np.where(leaves, 0, d), colorIndex, self.palette, self.round, leaves)
+
+	## Return the nodes computed so far as SolidPython objects.
+	#  @return a union with the node list.
+	def getNodes(self):
+		return self.store.toSolid()
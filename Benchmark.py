@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# Benchmarks for the model generation pipeline.
+#
+# To run a benchmark:
+# - python Benchmark.py \<benchmark\> [\<rule name\>]
+# - \<benchmark\> can be any key of the BENCHMARKS dictionary, e.g. python Benchmark.py interpreter TwoDTree4
+#
+
+from __future__ import division
+
+import os
+import sys
+import time
+import tempfile
+import multiprocessing
+
+from LSystems import LSystem
+from Rules import Rules
+from Compiler import compileSentence
+from Derivation import Derivation
+from BuildTree import BuildTree
+
+## Return the result of calling func and the elapsed wall time in seconds.
+def timeIt(func, *args):
+	start = time.time()
+	result = func(*args)
+	return result, time.time() - start
+
+## Print a throughput line.
+def report(name, count, unit, seconds):
+	rate = count / seconds if seconds > 0 else float("inf")
+	print("%-24s %10d %s in %8.3fs -> %12.0f %s/s" % (name, count, unit, seconds, rate, unit))
+
+## Compare the character by character interpreter against the compiled one.
+#  @param rule - an LSysObj
+def interpreter(rule):
+	lSys = LSystem()
+	sentence = lSys.buildLSystem(rule.iterations, rule.sentence, rule.rules, rule.rulesStochastic)
+	n = len(sentence)
+
+	result, seconds = timeIt(lSys.drawCharacters, rule.color, sentence, rule.angle, 4)
+	report("characters", n, "symbols", seconds)
+
+	program, compileSeconds = timeIt(compileSentence, sentence, rule.angle)
+	report("compile", n, "symbols", compileSeconds)
+
+	result, seconds = timeIt(lSys.execute, rule.color, program, 4)
+	report("execute", n, "symbols", seconds)
+	report("compile + execute", n, "symbols", compileSeconds + seconds)
+
+## Compare the derivation and compilation of string sentences against encoded byte sentences.
+#  @param rule - an LSysObj
+def derivation(rule):
+	d = Derivation(rule.rules)
+	for name, sentence in (("string", rule.sentence), ("encoded", d.encode(rule.sentence))):
+		result, seconds = timeIt(d.build, rule.iterations, sentence)
+		report(name + " derive", len(result), "symbols", seconds)
+		program, seconds = timeIt(compileSentence, result, rule.angle)
+		report(name + " compile", len(result), "symbols", seconds)
+
+## Return the peak resident set size of the current process in megabytes.
+def peakRSS():
+	import resource
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# ru_maxrss is given in bytes on MacOS and in kilobytes elsewhere.
+	return rss / (1 << 20) if sys.platform == "darwin" else rss / (1 << 10)
+
+## Draw a rule with the given exporter and put (seconds, peak RSS, file size) in the queue.
+#  Runs in its own process, so that the peak RSS of one exporter does not hide the other.
+def exportWorker(exporter, rule, queue):
+	os.chdir(tempfile.mkdtemp())
+	tree = BuildTree()
+	tree.setExporter(exporter)
+	filepath, seconds = timeIt(tree.draw, False, rule)
+	size = os.path.getsize(filepath)
+	os.remove(filepath)
+	queue.put((seconds, peakRSS(), size))
+
+## Compare the SolidPython exporter against the streaming scad and stl writers.
+#  @param rule - an LSysObj
+#  @param exporters - exporters to compare, see BuildTree.setExporter
+def export(rule, exporters=("solid", "stream", "table", "stl")):
+	context = multiprocessing.get_context("spawn")
+	for exporter in exporters:
+		queue = context.Queue()
+		p = context.Process(target=exportWorker, args=(exporter, rule, queue))
+		p.start()
+		seconds, rss, size = queue.get()
+		p.join()
+		print("%-24s %8.3fs  peak RSS %8.1f MB  file %10d bytes" % (exporter, seconds, rss, size))
+
+## Available benchmarks.
+BENCHMARKS = {"interpreter": interpreter, "derivation": derivation, "export": export}
+
+## Main program for benchmarking.
+def main(argv=None):
+	if argv is None:
+		argv = sys.argv
+
+	if len(argv) < 2 or argv[1] not in BENCHMARKS:
+		print("Usage: python Benchmark.py <%s> [rule name]" % "|".join(sorted(BENCHMARKS)))
+		return 1
+
+	ruleName = argv[2] if len(argv) > 2 else "TwoDTree4"
+	rules = Rules().fetchRules()
+	if ruleName not in rules:
+		print("Unknown rule: %s. Available rules: %s" % (ruleName, ", ".join(sorted(rules))))
+		return 1
+
+	BENCHMARKS[argv[1]](rules[ruleName])
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# An index of the branches of a derived sentence or of a compiled program.
+#
+# The matching bracket and the branch depth of every position are computed at once with NumPy, so
+# that a branch can be skipped, pruned or handed over to another process without scanning it again.
+#
+
+import numpy as np
+
+from Compiler import PUSH, POP
+
+## The matching brackets and the branch depth of every position of a sentence or program.
+#
+#  Example usage:
+#  - index = BracketIndex.fromSentence("F[+F[-F]]F")
+#  - index.match[1]  -> 8, the ']' closing the '[' at 1
+#  - index.skip(1)   -> 9, the position after the branch
+#  - index.depth     -> [0 1 1 1 2 2 2 2 1 0]
+#  - index.prune(1)  -> mask of the positions outside the branches deeper than 1
+class BracketIndex(object):
+
+	## Constructor.
+	#  @param codes array of symbol codes, e.g. the opcodes of Compiler.compileSentence.
+	#  @param push code opening a branch.
+	#  @param pop code closing a branch.
+	def __init__(self, codes, push=PUSH, pop=POP):
+		codes = np.asarray(codes)
+		isPush = codes == push
+		isPop = codes == pop
+		after = np.cumsum(isPush, dtype=np.int64) - np.cumsum(isPop, dtype=np.int64)
+		if len(after) > 0 and after.min() < 0:
+			raise ValueError("Pop without a matching push at position %d" % int(np.argmax(after < 0)))
+
+		## Number of branches containing each position, brackets included.
+		self.depth = after + isPop
+
+		# Close the pushes that are still open with virtual pops past the end.
+		unclosed = int(after[-1]) if len(after) > 0 else 0
+		index = np.nonzero(isPush | isPop)[0]
+		level = self.depth[index]
+		if unclosed > 0:
+			index = np.concatenate((index, np.arange(len(codes), len(codes) + unclosed)))
+			level = np.concatenate((level, np.arange(unclosed, 0, -1)))
+
+		# Sorting the brackets by level, then by position, pairs each push with the following pop.
+		pairs = index[np.lexsort((index, level))].reshape(-1, 2)
+		pairs = pairs[pairs[:, 1] < len(codes)]
+		pairs = pairs[np.argsort(pairs[:, 0])]
+		## Positions of the matched pushes, in increasing order. Pushes that are never popped are left out.
+		self.pushes = pairs[:, 0]
+		## Positions of the pops matching the pushes.
+		self.pops = pairs[:, 1]
+		## Position of the matching bracket of each position, or -1.
+		self.match = np.full(len(codes), -1, dtype=np.int64)
+		self.match[self.pushes] = self.pops
+		self.match[self.pops] = self.pushes
+
+	## Return the index of a sentence of L-System symbols.
+	#  @param sentence the L-System string returned by LSystem.buildLSystem.
+	@classmethod
+	def fromSentence(cls, sentence):
+		codes = np.frombuffer(sentence.encode("ascii", "replace"), dtype=np.uint8)
+		return cls(codes, ord("["), ord("]"))
+
+	## Return the number of positions.
+	def __len__(self):
+		return len(self.depth)
+
+	## Return the position after the branch opened at i, or i + 1 if no branch is opened at i.
+	def skip(self, i):
+		j = self.match[i]
+		return j + 1 if j > i else i + 1
+
+	## Return the (push, pop) positions of the branches at the given depth, 1 being the top level.
+	def branches(self, depth=1):
+		selected = self.depth[self.pushes] == depth
+		return self.pushes[selected], self.pops[selected]
+
+	## Return a mask of the positions kept when the branches deeper than maxDepth are skipped.
+	def prune(self, maxDepth):
+		return self.depth <= maxDepth
+
+	## Return the number of branches, the deepest branch, the mean branch length and the number of branches per depth.
+	def stats(self):
+		lengths = self.pops - self.pushes - 1
+		perDepth = np.bincount(self.depth[self.pushes])[1:] if len(self.pushes) > 0 else np.zeros(0, dtype=int)
+		return {"branches": len(self.pushes), "maxDepth": int(self.depth.max()) if len(self) > 0 else 0,
+				"meanLength": float(lengths.mean()) if len(lengths) > 0 else 0.0,
+				"perDepth": [int(n) for n in perDepth]}
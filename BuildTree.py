@@ -10,7 +10,11 @@
 
 from __future__ import division
 
+import os
 import sys
+import shutil
+import hashlib
+import tempfile
 sys.path.append('~/cg/python/OpenPolyhedra')
 import numpy as np
 import math as math
@@ -18,6 +22,18 @@ import math as math
 from LSystems import LSystem
 from RecTree import RecTree
 from Rules import Rules
+from Estimator import Estimator, BudgetExceeded
+from SegmentStore import SegmentStore
+from ScadWriter import ScadWriter, ScadTableWriter, fmt, fmtList, FLOWER_MODULE
+from Mesh import StlWriter, cylinderTriangles, transformTriangles
+from Manifold import ManifoldBuilder
+from Optimize import CollinearMerger
+from LOD import LEVELS, Culler
+from ModelCache import ModelCache
+from Pipeline import Pipeline
+from Progress import BuildCancelled, ProgressSink
+from ParallelRender import ParallelRenderer
+import matrix
 
 # Assumes SolidPython is in site-packages or elsewhwere in sys.path
 from solid import *
@@ -26,6 +42,9 @@ from solid.utils import *
 class BuildTree():
 
 	SEGMENTS = 48
+
+	## Extension of the files written by each exporter, when it is not scad.
+	EXTENSIONS = {"stl": ".stl", "manifold": ".stl", "obj": ".obj", "parallel": ".stl"}
 	
 	def __init__(self):
 		self.recTree = RecTree()
@@ -35,15 +54,42 @@ class BuildTree():
 		self.axis = "+X"
 		self.diameter = 6
 		self.filepathCounter = 0
+		## Maximum predicted cost of a model, keyed by the fields of Estimator.estimate.
+		self.budget = {}
+		## How the L-System models are written, see setExporter.
+		self.exporter = "solid"
+		## Distance between the samples of the manifold exporters, or None to derive it from the branch radii.
+		self.voxel = None
+		## Level of detail of the L-System models, see setLod.
+		self.lod = None
+		## ModelCache of the L-System models, or None to always generate them.
+		self.cache = None
+		## Whether the random number generators were seeded, so that stochastic models can be cached.
+		self.seeded = False
+		## Pipeline keeping the stages of the last L-System model, or None to run every stage each time.
+		self.pipeline = None
+		## Progress.Progress told about the progress of the L-System models, or None.
+		self.progress = None
+		## Number of spatial parts and of concurrent OpenSCAD processes of the parallel exporter, None for one per core.
+		self.renderParts = None
+		self.renderWorkers = None
 	
 	## Draws a tree in the orientation defined by the axis class variable.
 	#  The tree can be either purely recursive or use l-system rules. A Base can be added to the model.
+	#  @return the path of the generated scad file, or stl/obj file with the mesh exporters
 	def draw(self, rec = False, rule = None):
-		if rec:
-			# Rotate the tree that is built on the Z axis by the default to alignn to the X axis
-			lTree = rotate(a = 90, v = [0,1,0])(self.recTree.genTree())
+		self.filepathCounter += 1
+
 		if not rec and rule is not None:
-			lTree = self.lSys.lSystem(rule.color, rule.iterations, rule.sentence, rule.angle, 4, rule.rules, rule.rulesStochastic)
+			filepath = "lSystemModel" + str(self.filepathCounter) + self.extension()
+			if self.cache is not None:
+				return self.drawCached(rule, filepath)
+			self.checkBudget(rule)
+			return self.export(rule, filepath)
+
+		filepath = "lSystemModel" + str(self.filepathCounter) + ".scad"
+		# Rotate the tree that is built on the Z axis by the default to alignn to the X axis
+		lTree = rotate(a = 90, v = [0,1,0])(self.recTree.genTree())
 
 		rot = self.fetchRot()
 		lTree = rotate(a = rot[1], v = rot[0])(lTree)
@@ -51,10 +97,333 @@ class BuildTree():
 		if self.base:
 			lTree = union() (lTree, self.treeWithBase())
 		
+		scad_render_to_file(lTree, filepath = filepath, file_header='$fn = %s;\n\n%s' % (self.SEGMENTS, FLOWER_MODULE), include_orig_code=True)
+		return filepath
+
+	## Draws the same L-System tree once per level of detail. The tree is generated once,
+	#  so that a stochastic tree looks the same at every level.
+	#  @param rule - an LSysObj
+	#  @param lods - list of LevelOfDetail objects, or names of LOD.LEVELS
+	#  @return the list of generated file paths, one per level
+	def drawLods(self, rule, lods = ("preview", "print")):
+		self.checkBudget(rule)
 		self.filepathCounter += 1
-		
-		scad_render_to_file(lTree, filepath = "lSystemModel" + str(self.filepathCounter) + ".scad", file_header='$fn = %s;' % self.SEGMENTS, include_orig_code=True)
-		
+		source = SegmentStore(capacity=4096)
+		self.generator(rule)(source)
+
+		filepaths = []
+		for i, lod in enumerate(lods):
+			lod = LEVELS[lod] if lod in LEVELS else lod
+			filepath = "lSystemModel" + str(self.filepathCounter) + "_lod" + str(i) + self.extension()
+			self.writeModel(lambda store: store.append(source), filepath, lod)
+			filepaths.append(filepath)
+		return filepaths
+
+	## Returns the cached file of the given rule, or draws it and adds it to the cache.
+	#  Models drawing random numbers are only cached when the random number generators were seeded and no
+	#  pipeline keeps their stages. The state of the generators after drawing is kept with their file and
+	#  restored on a hit, so the next trees are the same either way.
+	#  @param rule - an LSysObj
+	#  @param filepath - path of the file written on a miss
+	#  @return the path of the cached or generated file
+	def drawCached(self, rule, filepath):
+		random = self.usesRandomness(rule)
+		if random and (not self.seeded or self.pipeline is not None):
+			self.checkBudget(rule)
+			return self.export(rule, filepath)
+
+		key = self.cache.key(rule, self.cacheOptions(rule))
+		path = self.cache.get(key, self.extension())
+		if path is not None:
+			state = self.cache.metadata(key).get("state")
+			if random and state is not None:
+				self.lSys.setState(state)
+			return path
+
+		self.checkBudget(rule)
+		filepath = self.export(rule, filepath)
+		self.cache.put(key, filepath, {"state": self.lSys.getState()} if random else None)
+		return filepath
+
+	## Returns whether the model of the given rule draws random numbers: the stochastic rules
+	#  choose their successors at random, and the flowers (L) pick a random color.
+	#  @param rule - an LSysObj
+	def usesRandomness(self, rule):
+		if self.lSys.stochastic:
+			return True
+		return "L" in rule.sentence or any("L" in successor for successor in rule.rules.values())
+
+	## Returns the options the L-System models depend on, used to build their cache key.
+	#  @param rule - the LSysObj of the model
+	def cacheOptions(self, rule):
+		options = self.exportOptions()
+		options.update({"spheres": self.lSys.spheres, "stochastic": self.lSys.stochastic, "merge": self.lSys.merge,
+						"pruneDepth": self.lSys.pruneDepth})
+		if self.usesRandomness(rule):
+			options["state"] = hashlib.sha256(repr(self.lSys.getState()).encode("utf-8")).hexdigest()
+		if self.lSys.stochastic:
+			generations = self.lSys.generationsKey(rule.iterations, rule.sentence, rule.rules, rule.rulesStochastic)
+			if generations is not None:
+				options["generations"] = hashlib.sha256(repr(generations).encode("utf-8")).hexdigest()
+		return options
+
+	## Returns the options the export of the L-System models depends on.
+	def exportOptions(self):
+		options = {"axis": self.axis, "base": self.base, "diameter": self.diameter, "segments": self.SEGMENTS,
+				   "exporter": self.exporter, "voxel": self.voxel, "lod": vars(self.lod) if self.lod is not None else None}
+		if self.exporter == "parallel":
+			# The parts are merged without a union, so the file depends on how the model was split.
+			options["parts"] = ParallelRenderer(self.renderParts, self.renderWorkers).parts
+		return options
+
+	## Sets the cache of the L-System models: True for a ModelCache in the default directory,
+	#  a ModelCache, or False/None to always generate the models.
+	def useCache(self, cache):
+		if cache is True:
+			cache = ModelCache()
+		self.cache = cache if cache else None
+
+	## Returns the extension of the files written by the current exporter.
+	def extension(self):
+		return self.EXTENSIONS.get(self.exporter, ".scad")
+
+	## Sets how the L-System models are written.
+	#  - solid - build a SolidPython object tree and render it with scad_render_to_file
+	#  - stream - write each node to the scad file as soon as it is drawn
+	#  - table - write a segment module and a table of segment parameters iterated by a for loop
+	#  - stl - tessellate the nodes and write a binary stl file, without OpenSCAD
+	#  - manifold - build a single watertight surface around the branches and write it to a binary stl file
+	#  - obj - same as manifold, written to a Wavefront obj file
+	#  - parallel - render spatial parts of the model with concurrent OpenSCAD processes and merge them into a stl file
+	def setExporter(self, exporter):
+		self.exporter = exporter
+
+	## Sets the number of spatial parts and of concurrent OpenSCAD processes of the parallel exporter.
+	#  None uses one per core.
+	def setParallel(self, parts=None, workers=None):
+		self.renderParts = parts
+		self.renderWorkers = workers
+
+	## Sets the distance between the samples of the manifold exporters. None derives it from the branch radii.
+	def setVoxel(self, voxel):
+		self.voxel = voxel
+
+	## Sets the level of detail of the L-System models: a LevelOfDetail, a name of LOD.LEVELS,
+	#  or None to use SEGMENTS fragments everywhere and keep every cylinder.
+	def setLod(self, lod):
+		self.lod = LEVELS[lod] if lod in LEVELS else lod
+
+	## Returns a function drawing the model of the given rule into a SegmentStore.
+	#  @param rule - an LSysObj
+	def generator(self, rule):
+		return lambda store: self.lSys.lSystemSegments(rule.color, rule.iterations, rule.sentence, rule.angle, 4,
+													   rule.rules, rule.rulesStochastic, store)
+
+	## Writes the model of the given rule with the current exporter and level of detail.
+	#  @param rule - an LSysObj
+	#  @param filepath - path of the written file
+	#  @return the path of the file, which is the file of the last model when the pipeline reuses it
+	def export(self, rule, filepath):
+		if self.pipeline is not None and not self.lSys.streaming:
+			return self.pipeline.run(rule, filepath)
+		self.writeModel(self.generator(rule), filepath, self.lod)
+		return filepath
+
+	## Writes a model with the current exporter.
+	#  @param fill - function drawing the model into a SegmentStore
+	#  @param filepath - path of the written file
+	#  @param lod - a LevelOfDetail, or None
+	#  A cancelled model is not left half written.
+	def writeModel(self, fill, filepath, lod):
+		try:
+			if self.exporter == "solid":
+				self.writeSolid(fill, filepath, lod)
+			elif self.exporter == "stl":
+				self.writeMesh(fill, filepath, lod)
+			elif self.exporter in ("manifold", "obj"):
+				self.writeManifold(fill, filepath, lod)
+			elif self.exporter == "parallel":
+				self.writeParallel(fill, filepath, lod)
+			else:
+				self.writeScad(fill, filepath, lod)
+		except BuildCancelled:
+			if os.path.exists(filepath):
+				os.remove(filepath)
+			raise
+		if self.progress is not None:
+			self.progress.report("bytes", os.path.getsize(filepath))
+
+	## Writes a model to a scad file through a SolidPython object tree.
+	#  @see writeModel
+	def writeSolid(self, fill, filepath, lod):
+		store = SegmentStore(capacity=4096)
+		fill(store)
+		if lod is not None:
+			print("Culled segments: " + str(lod.cull(store)))
+		lTree = store.toSolid(lod)
+
+		rot = self.fetchRot()
+		lTree = rotate(a = rot[1], v = rot[0])(lTree)
+
+		if self.base:
+			lTree = union() (lTree, self.treeWithBase())
+
+		scad_render_to_file(lTree, filepath = filepath, file_header='$fn = %s;\n\n%s' % (self.SEGMENTS, FLOWER_MODULE), include_orig_code=True)
+
+	## Writes a model to a scad file without building a SolidPython object tree.
+	#  @param base - whether to add the base, or None to add it when useBase is set
+	#  @param cull - whether to drop the cylinders the level of detail culls, False when the store was culled before
+	#  @see writeModel
+	def writeScad(self, fill, filepath, lod, base = None, cull = True):
+		rot = self.fetchRot()
+		with open(filepath, "w") as f:
+			if self.exporter == "table":
+				writer = ScadTableWriter(f, self.SEGMENTS, lod)
+			else:
+				writer = ScadWriter(f, self.SEGMENTS, lod)
+			writer.begin()
+			writer.open("rotate(a=%s, v=%s)" % (fmt(rot[1]), fmtList(rot[0])))
+			store = SegmentStore(capacity=4096, sink=self.sink(writer.write, lod if cull else None, f))
+			fill(store)
+			store.flush()
+			self.report(store.sink)
+			writer.close()
+			if self.base if base is None else base:
+				writer.raw(scad_render(self.treeWithBase()).strip())
+			writer.end()
+
+	## Writes a model to a binary stl file, tessellating every node with NumPy.
+	#  @see writeModel
+	def writeMesh(self, fill, filepath, lod):
+		rot = self.fetchRot()
+		with open(filepath, "wb") as f:
+			writer = StlWriter(f, self.SEGMENTS, transform=matrix.rotate(rot[1], rot[0][0], rot[0][1], rot[0][2]), lod=lod)
+			writer.begin()
+			store = SegmentStore(capacity=4096, sink=self.sink(writer.write, lod, f))
+			fill(store)
+			store.flush()
+			self.report(store.sink)
+			if self.base:
+				m = matrix.rotate(rot[3], rot[2][0], rot[2][1], rot[2][2])
+				for r1, r2, h, fn in self.baseCylinders():
+					writer.writeTriangles(transformTriangles(cylinderTriangles(fn, r1, r2, h), m))
+			writer.end()
+
+	## Writes a model to a stl file rendered by concurrent OpenSCAD processes, one spatial part at a time.
+	#  The base is rendered as a part of its own.
+	#  @see writeModel
+	#  @see ParallelRender
+	def writeParallel(self, fill, filepath, lod):
+		store = SegmentStore(capacity=4096)
+		fill(store)
+		if lod is not None:
+			print("Culled segments: " + str(lod.cull(store)))
+
+		renderer = ParallelRenderer(self.renderParts, self.renderWorkers, progress=self.progress)
+		directory = tempfile.mkdtemp(prefix="lSystemModel")
+		try:
+			scadPaths = []
+			for i, index in enumerate(renderer.partition(store)):
+				part = store.take(index)
+				scadPaths.append(os.path.join(directory, "part%d.scad" % i))
+				self.writeScad(lambda s: s.append(part), scadPaths[-1], lod, base = False, cull = False)
+			if self.base:
+				scadPaths.append(os.path.join(directory, "base.scad"))
+				self.writeScad(lambda s: None, scadPaths[-1], None, base = True)
+			print("Rendering %d parts with %d processes" % (len(scadPaths), min(len(scadPaths), renderer.workers)))
+			renderer.render(scadPaths, filepath)
+		finally:
+			shutil.rmtree(directory)
+
+	## Returns the sink of the stores written by the exporters.
+	#  The sink fuses the collinear cylinders when merging is on, and culls the cylinders the level of detail drops.
+	#  @param write - function writing the rows of a store
+	#  @param lod - a LevelOfDetail, or None
+	#  @param f - the file written, whose size is reported when there is a Progress, or None
+	def sink(self, write, lod = None, f = None):
+		if self.progress is not None:
+			write = ProgressSink(self.progress, write, f)
+		if lod is not None:
+			write = Culler(lod, write)
+		return CollinearMerger(write) if self.lSys.merge else write
+
+	## Prints the number of cylinders eliminated by the sinks returned by sink.
+	def report(self, sink):
+		while isinstance(sink, (CollinearMerger, Culler)):
+			if isinstance(sink, CollinearMerger):
+				print("Merged segments: " + str(sink.eliminated))
+			else:
+				print("Culled segments: " + str(sink.removed))
+			sink = sink.sink
+
+	## Writes a model as a single watertight mesh, to a binary stl or obj file.
+	#  The joints are always rounded, as with the spheres option. The level of detail only culls cylinders,
+	#  the resolution of the mesh is set by setVoxel.
+	#  @see writeModel
+	def writeManifold(self, fill, filepath, lod):
+		rot = self.fetchRot()
+		store = SegmentStore(capacity=4096)
+		fill(store)
+		if lod is not None:
+			print("Culled segments: " + str(lod.cull(store)))
+
+		builder = ManifoldBuilder(self.voxel)
+		builder.addStore(store, matrix.rotate(rot[1], rot[0][0], rot[0][1], rot[0][2]))
+		if self.base:
+			m = matrix.rotate(rot[3], rot[2][0], rot[2][1], rot[2][2])
+			for r1, r2, h, fn in self.baseCylinders():
+				builder.addCone(m, r1, r2, h)
+		builder.build()
+
+		if self.exporter == "obj":
+			with open(filepath, "w") as f:
+				builder.writeObj(f)
+		else:
+			with open(filepath, "wb") as f:
+				builder.writeStl(f)
+
+	## Returns the predicted cost of generating the model of the given rule.
+	#  @param rule - an LSysObj
+	#  @see Estimator.estimate
+	def estimate(self, rule):
+		return Estimator(rule, self.lSys.stochastic, self.lSys.spheres).estimate()
+
+	## Sets the maximum predicted cost of the models to be drawn. A None value removes that limit.
+	#  @param nodes - maximum number of nodes
+	#  @param memory - maximum number of bytes of memory
+	#  @param scadSize - maximum number of bytes of the scad file
+	def setBudget(self, nodes=None, memory=None, scadSize=None):
+		self.budget = {}
+		for key, value in (("nodes", nodes), ("memory", memory), ("scadSize", scadSize)):
+			if value is not None:
+				self.budget[key] = value
+
+	## Raises BudgetExceeded if the predicted cost of the given rule exceeds the budget.
+	#  @param rule - an LSysObj
+	def checkBudget(self, rule):
+		if not self.budget:
+			return
+		cost = self.estimate(rule)
+		for key, limit in self.budget.items():
+			if cost[key] > limit:
+				raise BudgetExceeded("Predicted %s of %d exceeds the budget of %d" % (key, cost[key], limit))
+
+	## Seeds the random number generators of the L-System and of the recursive tree,
+	#  so that the same seed always draws the same tree.
+	def seed(self, seed):
+		self.lSys.seed(seed)
+		self.recTree.seed(seed)
+		self.seeded = True
+
+	## Returns the state of the random number generators, which can be pickled.
+	def getState(self):
+		return {"lSystem": self.lSys.getState(), "recTree": self.recTree.getState()}
+
+	## Restores a state returned by getState.
+	def setState(self, state):
+		self.lSys.setState(state["lSystem"])
+		self.recTree.setState(state["recTree"])
+		self.seeded = True
 
 	## Defines whether to apply a stochastic interpretation of the rules  to the tree model or not.
 	def useStochastic(self, state):
@@ -71,6 +440,48 @@ class BuildTree():
 	## Defines whether to add spheres between cylinder connections or not.
 	def useSpheres(self, state):
 		self.lSys.useSpheres(state)
+
+	## Defines whether the L-System program is interpreted all at once with NumPy instead of symbol by symbol.
+	def useBatch(self, state):
+		self.lSys.useBatch(state)
+
+	## Sets the number of processes interpreting the top-level branches of the L-System programs,
+	#  or None to use a single process. Only used with useBatch.
+	def setWorkers(self, workers):
+		self.lSys.setWorkers(workers)
+
+	## Sets the deepest branch nesting drawn by the L-System models, or None to draw every branch.
+	def setPruneDepth(self, depth):
+		self.lSys.setPruneDepth(depth)
+
+	## Defines whether the L-System sentences are derived as byte arrays with NumPy instead of strings.
+	def useEncoded(self, state):
+		self.lSys.useEncoded(state)
+
+	## Sets the size in bytes above which the derived L-System generations are spilled to memory mapped files.
+	#  @see LSystem.setSpill
+	def setSpill(self, threshold, directory = None):
+		self.lSys.setSpill(threshold, directory)
+
+	## Defines whether consecutive collinear cylinders are fused into a single cylinder.
+	def useMerge(self, state):
+		self.lSys.useMerge(state)
+
+	## Defines whether the L-System models are built by a Pipeline that reruns only the stages whose
+	#  parameters changed, e.g. only the interpretation and the export when the angle changes.
+	#  @see Pipeline
+	def usePipeline(self, state):
+		self.pipeline = Pipeline(self) if state else None
+
+	## Sets the Progress.Progress told about the generations derived, the segments emitted and the bytes
+	#  written by the L-System models, or None. Cancelling it stops the model being built.
+	def setProgress(self, progress):
+		self.progress = progress
+		self.lSys.setProgress(progress)
+
+	## Defines whether the L-System sentence is streamed to the turtle instead of being fully built first.
+	def useStreaming(self, state):
+		self.lSys.useStreaming(state)
 	
 	## Returns a tupple containing the rotation axis and angle for the tree as well as the ones for the base
 	#  Structure (Rot axis for tree, Rot angle for tree, Rot axis for base, Rot angle for base)
@@ -93,25 +504,27 @@ class BuildTree():
 	## Given a union of nodes, return the union of the tree with a base
 	#  @param tree - a union of nodes that composes the tree
 	def treeWithBase(self):
-		base = cylinder(r = self.diameter, h = 2)
-		base.add_param('$fn', 40)
-		
-		rTrunk1 = 20 if self.diameter >= 35 else 5.5
-		hTrunk1 = 10 if self.diameter >= 35 else 5
-		trunk1 = cylinder(r1 = rTrunk1, r2 = 0, h = hTrunk1)
-		trunk1.add_param('$fn', 5)
-		
-		trunk2 = cylinder(r1 = 2, r2 = 0, h = 4)
-		trunk2.add_param('$fn', 5)
+		parts = []
+		for r1, r2, h, fn in self.baseCylinders():
+			part = cylinder(r1 = r1, r2 = r2, h = h) if r1 != r2 else cylinder(r = r1, h = h)
+			part.add_param('$fn', fn)
+			parts.append(part)
 		
 		rot = self.fetchRot()
 		return union()(
 					   rotate(a = rot[3], v = rot[2])
-					   (base,
-						trunk1,
-						trunk2)
+					   (*parts)
 					   )
 
+	## Returns the cylinders of the base, before its rotation: the base plate and two cones holding the trunk.
+	#  @return a list of (bottom radius, top radius, height, number of fragments) tuples
+	def baseCylinders(self):
+		rTrunk1 = 20 if self.diameter >= 35 else 5.5
+		hTrunk1 = 10 if self.diameter >= 35 else 5
+		return [(self.diameter, self.diameter, 2, 40),
+				(rTrunk1, 0, hTrunk1, 5),
+				(2, 0, 4, 5)]
+
 if __name__ == '__main__':
 	
 	#recTree = treeWithBase(genTree(5))
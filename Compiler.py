@@ -0,0 +1,263 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# Compiles a derived L-System sentence into an array of turtle opcodes and interprets it.
+# The parenthesised angles are resolved once, at compile time, so the interpreter loop only dispatches
+# each opcode to the corresponding turtle method.
+#
+
+import math
+from array import array
+
+import numpy as np
+
+import matrix
+
+from Derivation import EncodedSentence, CHUNK_SYMBOLS
+
+## Move forward a step of length d (F and f).
+FORWARD = 0
+## Rotate around the Z axis by the opcode argument (+, - and |).
+YAW = 1
+## Rotate around the Y axis by the opcode argument (& and ^).
+PITCH = 2
+## Rotate around the X axis by the opcode argument (\ and /).
+ROLL = 3
+## Push the turtle state to the stack ([).
+PUSH = 4
+## Pop the turtle state from the stack (]).
+POP = 5
+## Change the cylinder radius by the opcode argument times the current radius (> and <).
+RADIUS = 6
+## Add a flower (L).
+LEAF = 7
+## Change the cylinder height by the opcode argument times the current height (").
+HEIGHT = 8
+
+## Opcode names, indexed by opcode.
+NAMES = ["forward", "yaw", "pitch", "roll", "push", "pop", "radius", "leaf", "height"]
+
+## Percentage of cylinder reduction.
+PERCENT_REDUCTION = 0.20
+## Increase cylinder height by 30%.
+CYL_SCALE = 1.3
+## Radius of the flower spheres.
+LEAF_RADIUS = 1
+
+## Symbols whose opcode takes the current angle: symbol -> (opcode, sign).
+ROTATIONS = {'+': (YAW, 1), '-': (YAW, -1), '&': (PITCH, 1), '^': (PITCH, -1), '\\': (ROLL, 1), '/': (ROLL, -1)}
+
+## Symbols whose opcode has a fixed argument: symbol -> (opcode, argument).
+FIXED = {'F': (FORWARD, 0), 'f': (FORWARD, 0), '|': (YAW, 180), '[': (PUSH, 0), ']': (POP, 0), 'L': (LEAF, 0),
+		 '>': (RADIUS, -PERCENT_REDUCTION), '<': (RADIUS, PERCENT_REDUCTION), '"': (HEIGHT, CYL_SCALE)}
+
+## Translate the symbols of a sentence into (opcode, argument) pairs.
+#
+#  A number between parenthesis replaces the angle of the command that follows the closing parenthesis,
+#  e.g. (90)& pitches down by 90 degrees. Digits, parenthesis and unknown symbols produce no opcode.
+#
+#  @param symbols - the L-System string returned by buildLSystem, or any iterable of symbols
+#  @param angle - default angle of rotation
+#  @return a generator of (opcode, argument) pairs
+def tokenize(symbols, angle):
+	accumAngle = ""
+	finishedAccumAng = False
+
+	for c in symbols:
+		a = int(accumAngle) if accumAngle != "" else angle
+
+		if finishedAccumAng:
+			accumAngle = ""
+
+		op = FIXED.get(c)
+		if op is not None:
+			yield op
+			continue
+
+		rot = ROTATIONS.get(c)
+		if rot is not None:
+			yield (rot[0], rot[1] * a)
+		elif c.isdigit():
+			accumAngle = accumAngle + c
+		elif c == '(':
+			finishedAccumAng = False
+		elif c == ')':
+			finishedAccumAng = True
+
+## Compile a sentence into an opcode array and an argument array.
+#  @param symbols - the L-System string returned by buildLSystem, an EncodedSentence, or any iterable of symbols
+#  @param angle - default angle of rotation
+#  @return a tuple (ops, args) of arrays with one byte and one double per opcode
+def compileSentence(symbols, angle):
+	if isinstance(symbols, EncodedSentence):
+		return compileEncoded(symbols, angle)
+	ops = array('B')
+	args = array('d')
+	addOp = ops.append
+	addArg = args.append
+	for op, arg in tokenize(symbols, angle):
+		addOp(op)
+		addArg(arg)
+	return ops, args
+
+## Compile an EncodedSentence with NumPy, looking the opcode of every symbol code up in a table.
+#  Sentences with parenthesised angles are compiled symbol by symbol, since an angle changes the next opcode.
+#  @param sentence - an EncodedSentence
+#  @param angle - default angle of rotation
+#  @return a tuple (ops, args) of NumPy arrays with one byte and one double per opcode
+def compileEncoded(sentence, angle):
+	if hasAngles(sentence.table):
+		return compileSentence(iter(sentence), angle)
+	return compileCodes(sentence.codes, opcodeTables(sentence.table, angle))
+
+## Compile an EncodedSentence a chunk of symbols at a time, e.g. a sentence spilled to disk by the derivation.
+#  Only one chunk of the sentence is read into memory at a time.
+#  @param sentence - an EncodedSentence
+#  @param angle - default angle of rotation
+#  @return a generator of (opcode, argument) pairs
+def streamEncoded(sentence, angle):
+	if hasAngles(sentence.table):
+		for pair in tokenize(iter(sentence), angle):
+			yield pair
+		return
+	tables = opcodeTables(sentence.table, angle)
+	for start in range(0, len(sentence), CHUNK_SYMBOLS):
+		ops, args = compileCodes(sentence.codes[start:start + CHUNK_SYMBOLS], tables)
+		for pair in zip(ops.tolist(), args.tolist()):
+			yield pair
+
+## Return whether a symbol table has the symbols of parenthesised angles.
+def hasAngles(table):
+	return any(c.isdigit() or c in "()" for c in table.symbols)
+
+## Symbol codes without an opcode.
+NO_OPCODE = 255
+
+## Return the opcode and the argument of every code of a symbol table, NO_OPCODE for the symbols without an opcode.
+def opcodeTables(table, angle):
+	opTable = np.full(len(table), NO_OPCODE, dtype=np.uint8)
+	argTable = np.zeros(len(table))
+	for i, c in enumerate(table.symbols):
+		if c in FIXED:
+			opTable[i], argTable[i] = FIXED[c]
+		elif c in ROTATIONS:
+			opTable[i], argTable[i] = ROTATIONS[c][0], ROTATIONS[c][1] * angle
+	return opTable, argTable
+
+## Return the opcodes and the arguments of an array of symbol codes.
+def compileCodes(codes, tables):
+	opTable, argTable = tables
+	ops = opTable[codes]
+	keep = ops != NO_OPCODE
+	return ops[keep], argTable[codes[keep]]
+
+## Run a program on a turtle.
+#  @param t - the turtle
+#  @param program - a tuple (ops, args) returned by compileSentence, or an iterable of (opcode, argument) pairs
+#  @param d - length of each step
+#  @param step - function called every interval opcodes, e.g. to report the progress, or None
+#  @param interval - number of opcodes between two calls of step
+#
+#  The rotation matrix of each (opcode, angle) pair is built once, as in BatchTurtle.localTransforms,
+#  and the steps and pops of a turtle in standard mode update its state directly, giving the same nodes
+#  as the turtle methods without building a matrix per opcode.
+def interpret(t, program, d, step=None, interval=4096):
+	stack = []
+	if t.isDebug() or t.showAxes or t.mode() != "standard" or d <= 0:
+		return interpretCalls(t, program, d, stack, step, interval)
+	# Cylinders are drawn along the x axis of the turtle.
+	toX = np.asarray(matrix.rotate(90, 0, 1, 0))
+	translation = np.identity(4)
+
+	def push(arg):
+		stack.append((t.curPoint, t.rotVector, t.rotMatrix, t.r))
+
+	# Same as turtle.setposition with the pen up, followed by turtle.pendown.
+	def pop(arg):
+		point, t.rotVector, t.rotMatrix, t.r = stack.pop()
+		if not t.controlColor:
+			t.pencolor("pumpkin orange")
+		v = np.subtract(point[:3], t.curPoint[:3])
+		dist = math.sqrt(v[0] * v[0] + v[1] * v[1] + v[2] * v[2])
+		if dist > 0:
+			t.h = dist
+			t.curPoint = np.array([point[0], point[1], point[2], 1])
+		t.pendown()
+
+	# Same as turtle.forward.
+	def forward(arg):
+		if t.rotVector is None:
+			t.forward(d)
+			return
+		t.h = d
+		if t.down:
+			translation[:3, 3] = t.curPoint[:3]
+			m = np.dot(translation, np.dot(t.rotMatrix, toX))
+			t.addNode(m.tolist())
+		t.curPoint = np.add(t.curPoint, d * t.rotVector)
+
+	def rotation(direction, x, y, z):
+		rotations = {}
+
+		# Same as turtle.yaw, turtle.pitch and turtle.roll.
+		def rotate(arg):
+			m = rotations.get(arg)
+			if m is None:
+				m = rotations[arg] = np.asarray(matrix.rotate(arg, x, y, z))
+			t.setDirection(direction)
+			t.rotMatrix = np.dot(np.asarray(t.rotMatrix), m)
+			t.rotVector = np.dot(t.initialVector, t.rotMatrix.T)
+		return rotate
+
+	handlers = [forward, rotation('Z', 0, 0, 1), rotation('Y', 0, 1, 0), rotation('X', 1, 0, 0), push, pop]
+	run(handlers + opHandlers(t), program, step, interval)
+
+## Run a program by calling the turtle methods of each opcode.
+#  @see interpret
+def interpretCalls(t, program, d, stack, step, interval):
+	def push(arg):
+		stack.append((t.curPoint, t.rotVector, t.rotMatrix, t.r))
+
+	def pop(arg):
+		val = stack.pop()
+		t.penup()
+		t.setposition(val[0][0], val[0][1], val[0][2])
+		t.pendown()
+		t.rotVector = val[1]
+		t.rotMatrix = val[2]
+		t.r = val[3]
+
+	def forward(arg):
+		t.forward(d)
+
+	run([forward, t.yaw, t.pitch, t.roll, push, pop] + opHandlers(t), program, step, interval)
+
+## Return the handlers of the radius, leaf and height opcodes.
+def opHandlers(t):
+	def radius(arg):
+		t.r += arg * t.r
+
+	def height(arg):
+		t.h += arg * t.h
+
+	def leaf(arg):
+		t.addLeaf(r = LEAF_RADIUS)
+
+	return [radius, leaf, height]
+
+## Call the handler of each opcode of a program.
+#  @param handlers - functions taking the argument of an opcode, indexed by opcode
+#  @see interpret
+def run(handlers, program, step, interval):
+	if isinstance(program, tuple):
+		program = zip(*program)
+	if step is None:
+		for op, arg in program:
+			handlers[op](arg)
+		return
+	for i, (op, arg) in enumerate(program, 1):
+		handlers[op](arg)
+		if i % interval == 0:
+			step()
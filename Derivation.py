@@ -0,0 +1,477 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# Iterative rewriting engine for the L-System rules.
+# The sentence is expanded one generation at a time into a buffer that is joined once per generation,
+# so the depth of a derivation is no longer bounded by the Python recursion limit.
+#
+
+import os
+import random
+import weakref
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+## Number of symbols rewritten at once by the vectorized rewriting of encoded sentences.
+CHUNK_SYMBOLS = 1 << 16
+
+## Maps the symbols of a derivation to dense one byte codes.
+#
+#  Example usage:
+#  - table = SymbolTable("F+-[]")
+#  - codes = table.encode("F[+F]")  -> uint8 array
+#  - table.decode(codes)  -> "F[+F]"
+class SymbolTable():
+
+	## Constructor.
+	#  @param symbols - the symbols of the table, at most 256
+	def __init__(self, symbols):
+		## Symbol of each code.
+		self.symbols = sorted(set(symbols))
+		if len(self.symbols) > 256:
+			raise ValueError("Too many symbols for one byte codes: %d" % len(self.symbols))
+		## Code of each symbol.
+		self.codes = dict((c, i) for i, c in enumerate(self.symbols))
+		# Translate the latin-1 bytes of a string into codes, and the codes back.
+		self.toCode = np.zeros(256, dtype=np.uint8)
+		self.toCode[[ord(c) for c in self.symbols]] = np.arange(len(self.symbols))
+		self.toByte = np.array([ord(c) for c in self.symbols], dtype=np.uint8)
+
+	## Return the number of symbols.
+	def __len__(self):
+		return len(self.symbols)
+
+	## Return the codes of a string whose symbols are all in the table.
+	def encode(self, text):
+		return self.toCode[np.frombuffer(text.encode("latin-1"), dtype=np.uint8)]
+
+	## Return the string of an array of codes.
+	def decode(self, codes):
+		return self.toByte[codes].tobytes().decode("latin-1")
+
+## A sentence held as an array of one byte codes and the SymbolTable of the codes.
+#  It takes one byte per symbol and is rewritten with NumPy, see Derivation.step.
+class EncodedSentence():
+
+	## Constructor.
+	#  @param codes - uint8 array of symbol codes
+	#  @param table - the SymbolTable of the codes
+	def __init__(self, codes, table):
+		self.codes = codes
+		self.table = table
+
+	## Return the number of symbols.
+	def __len__(self):
+		return len(self.codes)
+
+	## Return the sentence as a string.
+	def __str__(self):
+		return self.table.decode(self.codes)
+
+	## Iterate over the symbols, one string of one character at a time.
+	def __iter__(self):
+		for start in range(0, len(self.codes), CHUNK_SYMBOLS):
+			for c in self.table.decode(self.codes[start:start + CHUNK_SYMBOLS]):
+				yield c
+
+	## Return whether the codes are memory mapped from a file on disk instead of held in memory.
+	def spilled(self):
+		return isinstance(self.codes, np.memmap)
+
+## Writes the codes of a generation to a temporary file, a chunk at a time, and maps the file into memory.
+#  The file is removed as soon as it is mapped where the platform allows it, or else when the mapping is released.
+#
+#  Example usage:
+#  - spill = SpillFile()
+#  - spill.write(chunk) ...
+#  - codes = spill.map()  -> read only np.memmap
+class SpillFile():
+
+	## Constructor.
+	#  @param directory - directory of the temporary file, or None for the default temporary directory
+	def __init__(self, directory=None):
+		self.f = tempfile.NamedTemporaryFile(dir=directory, prefix="generation", suffix=".bin", delete=False)
+
+	## Append an array of codes.
+	def write(self, chunk):
+		self.f.write(np.ascontiguousarray(chunk).data)
+
+	## Close the file and return its memory mapped codes.
+	def map(self):
+		self.f.close()
+		path = self.f.name
+		if os.path.getsize(path) == 0:
+			os.remove(path)
+			return np.zeros(0, dtype=np.uint8)
+		codes = np.memmap(path, dtype=np.uint8, mode="r")
+		try:
+			os.remove(path)
+		except OSError:
+			weakref.finalize(codes, removeQuietly, path)
+		return codes
+
+	## Close and remove the file, e.g. after a write failed because the disk is full.
+	def discard(self):
+		try:
+			self.f.close()
+		except OSError:
+			pass
+		removeQuietly(self.f.name)
+
+## Remove a file, ignoring the errors.
+def removeQuietly(path):
+	try:
+		os.remove(path)
+	except OSError:
+		pass
+
+## Bounded LRU cache of symbol expansions shared by deterministic derivations.
+#
+#  Entries are keyed by (symbol, remaining depth, rule set) and the capacity is given in characters,
+#  so a handful of huge expansions cannot hold on to an unbounded amount of memory.
+class DerivationCache():
+
+	## Constructor.
+	#  @param capacity - maximum number of characters kept in the cache
+	def __init__(self, capacity=1 << 24):
+		self.capacity = capacity
+		self.clear()
+
+	## Remove every entry and reset the counters.
+	def clear(self):
+		self.entries = OrderedDict()
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	## Return the cached expansion for the given key, or None if it is not in the cache.
+	def get(self, key):
+		value = self.entries.get(key)
+		if value is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self.entries.move_to_end(key)
+		return value
+
+	## Store an expansion, evicting the least recently used entries if the capacity is exceeded.
+	def put(self, key, value):
+		if len(value) > self.capacity or key in self.entries:
+			return
+		self.entries[key] = value
+		self.size += len(value)
+		while self.size > self.capacity:
+			k, v = self.entries.popitem(last=False)
+			self.size -= len(v)
+			self.evictions += 1
+
+	## Return a dictionary with the cache counters.
+	def stats(self):
+		return {"entries": len(self.entries), "size": self.size, "capacity": self.capacity,
+				"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+## Expands a base sentence by repeatedly applying a set of production rules.
+#
+#  Only single character predecessors take part in the rewriting, exactly like the recursive
+#  LSystem.buildLSystem used to do: keys with more than one character never match a symbol.
+#
+#  Example usage:
+#  - d = Derivation({'F':"F[+F]F[-F]F"})
+#  - d.length(5, "F")  -> 7811
+#  - d.build(5, "F")   -> the derived sentence
+#  - d.stream(5, "F")  -> a generator yielding the same sentence one symbol at a time
+class Derivation():
+
+	## Constructor.
+	#  @param rules - a dictionary containing an axiom:rule key:value pair, they're both expected to be strings
+	#  @param sRules - a dictionary containing an axiom:[rules] key:value pair used by stochastic derivations
+	#  @param stochastic - whether to select a random rule among the sRules alternatives
+	#  @param rng - random number generator used to select the stochastic rules
+	#  @param cache - a DerivationCache shared by deterministic derivations, or None
+	#  @param progress - a Progress.Progress told about every generation derived, or None
+	#  @see encode to derive an EncodedSentence instead of a string
+	def __init__(self, rules, sRules=None, stochastic=False, rng=None, cache=None, progress=None):
+		self.rules = dict((k, v) for k, v in rules.items() if len(k) == 1)
+		self.sRules = dict((k, v) for k, v in (sRules or {}).items() if len(k) == 1 and len(v) > 0)
+		self.stochastic = stochastic
+		self.rng = rng if rng is not None else random
+		## Translation table used by str.translate for deterministic derivations.
+		self.table = dict((ord(k), v) for k, v in self.rules.items())
+		self.cache = cache
+		## Identifies the rule set in the cache keys.
+		self.key = tuple(sorted(self.rules.items()))
+		self.progress = progress
+		## Successor tables of the encoded rewriting, keyed by symbol table.
+		self.successorTables = {}
+		## Size in bytes above which encoded generations are spilled to disk, or None to keep them in memory.
+		self.spillThreshold = None
+		self.spillDirectory = None
+
+	## Spill the encoded generations larger than threshold bytes to memory mapped files.
+	#  @param threshold - size in bytes, or None to keep every generation in memory
+	#  @param directory - directory of the spilled files, or None for the default temporary directory
+	def setSpill(self, threshold, directory=None):
+		self.spillThreshold = threshold
+		self.spillDirectory = directory
+
+	## Return the symbols that may appear in a derivation of the given sentence.
+	#  @param sentence - initial sentence
+	def alphabet(self, sentence):
+		symbols = set(sentence)
+		for k, v in self.rules.items():
+			symbols.add(k)
+			symbols.update(v)
+		for k, arr in self.sRules.items():
+			symbols.add(k)
+			for v in arr:
+				symbols.update(v)
+		return symbols
+
+	## Return the length of the sentence derived after n generations without expanding it.
+	#  The length is exact for deterministic derivations.
+	#  For stochastic derivations the choices are not known in advance and None is returned.
+	#  @param n - number of generations
+	#  @param sentence - initial sentence
+	def length(self, n, sentence):
+		if self.stochastic:
+			return None
+		lengths = dict((c, 1) for c in self.alphabet(sentence))
+		for i in range(n):
+			lengths = dict((c, sum(lengths[x] for x in self.rules[c]) if c in self.rules else 1) for c in lengths)
+		return sum(lengths[c] for c in sentence)
+
+	## Return the successor of a single symbol, or None if no rule applies to it.
+	#  @param c - symbol to be rewritten
+	def rewrite(self, c):
+		if not self.stochastic:
+			return self.rules.get(c)
+		arr = self.sRules.get(c)
+		if arr is None:
+			return None
+		return arr[self.rng.randint(0, len(arr) - 1)]
+
+	## Return the EncodedSentence of an initial sentence, with a table of every symbol its derivations may contain.
+	#  Deriving an EncodedSentence gives EncodedSentence generations.
+	#  @param sentence - initial sentence
+	def encode(self, sentence):
+		table = SymbolTable(self.alphabet(sentence))
+		return EncodedSentence(table.encode(sentence), table)
+
+	## Return the successor tables of the encoded rewriting.
+	#  Every successor of every symbol, the symbol itself when no rule applies, is a variant. The codes of the
+	#  variants are concatenated in a buffer.
+	#  @return a tuple (first, counts, ruled, lengths, offsets, buffer): the first variant, the number of variants
+	#  and whether a stochastic rule applies, for each symbol, and the length and the offset in the buffer of each variant
+	def successors(self, table):
+		tables = self.successorTables.get(id(table))
+		if tables is not None and tables[0] is table:
+			return tables[1]
+		variants = []
+		first = np.empty(len(table), dtype=np.int64)
+		counts = np.empty(len(table), dtype=np.int64)
+		ruled = np.zeros(len(table), dtype=bool)
+		for i, c in enumerate(table.symbols):
+			if self.stochastic:
+				successors = self.sRules.get(c, [c])
+				ruled[i] = c in self.sRules
+			else:
+				successors = [self.rules.get(c, c)]
+			first[i] = len(variants)
+			counts[i] = len(successors)
+			variants.extend(successors)
+		lengths = np.array([len(v) for v in variants], dtype=np.int64)
+		offsets = np.cumsum(lengths) - lengths
+		buffer = table.encode("".join(variants))
+		tables = (first, counts, ruled, lengths, offsets, buffer)
+		self.successorTables[id(table)] = (table, tables)
+		return tables
+
+	## Return the variant of every symbol of an encoded sentence.
+	#  The stochastic choices are drawn in the order of the symbols, exactly like the string rewriting does.
+	def variants(self, codes, first, counts, ruled):
+		variant = first[codes]
+		if not self.stochastic:
+			return variant
+		randint = self.rng.randint
+		positions = np.nonzero(ruled[codes])[0]
+		choices = [randint(0, n - 1) for n in counts[codes[positions]].tolist()]
+		variant[positions] += np.array(choices, dtype=np.int64)
+		return variant
+
+	## Return the largest size of the next generation of an encoded sentence, exact for deterministic derivations.
+	def nextSize(self, sentence):
+		first, counts, ruled, lengths, offsets, buffer = self.successors(sentence.table)
+		largest = np.array([lengths[f:f + c].max() for f, c in zip(first, counts)], dtype=np.int64)
+		return sum(int(largest[sentence.codes[start:start + CHUNK_SYMBOLS]].sum())
+				   for start in range(0, len(sentence), CHUNK_SYMBOLS))
+
+	## Apply the rules once to an encoded sentence with NumPy.
+	#  The successors are gathered from the buffer of the successor tables, a chunk of symbols at a time.
+	#  A generation that may be larger than the spill threshold is written to a memory mapped file.
+	#  @param sentence - an EncodedSentence
+	#  @return the next generation, an EncodedSentence
+	def stepEncoded(self, sentence):
+		first, counts, ruled, lengths, offsets, buffer = self.successors(sentence.table)
+		codes = sentence.codes
+		spill = None
+		if self.spillThreshold is not None and self.nextSize(sentence) > self.spillThreshold:
+			spill = SpillFile(self.spillDirectory)
+		chunks = []
+		try:
+			for start in range(0, len(codes), CHUNK_SYMBOLS):
+				variant = self.variants(codes[start:start + CHUNK_SYMBOLS], first, counts, ruled)
+				size = lengths[variant]
+				ends = np.cumsum(size)
+				if len(ends) == 0 or ends[-1] == 0:
+					continue
+				index = np.repeat(offsets[variant] - (ends - size), size) + np.arange(ends[-1])
+				if spill is not None:
+					spill.write(buffer[index])
+				else:
+					chunks.append(buffer[index])
+			if spill is not None:
+				return EncodedSentence(spill.map(), sentence.table)
+		except BaseException:
+			# Do not leave a partial generation on a full disk.
+			if spill is not None:
+				spill.discard()
+			raise
+		result = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.uint8)
+		return EncodedSentence(result, sentence.table)
+
+	## Apply the rules once to every symbol of the given sentence.
+	#  @param sentence - the current generation, a string or an EncodedSentence
+	#  @return the next generation
+	def step(self, sentence):
+		if isinstance(sentence, EncodedSentence):
+			return self.stepEncoded(sentence)
+		if not self.stochastic:
+			return sentence.translate(self.table)
+
+		sRules = self.sRules
+		randint = self.rng.randint
+		buf = []
+		append = buf.append
+		for c in sentence:
+			arr = sRules.get(c)
+			if arr is None:
+				append(c)
+			else:
+				append(arr[randint(0, len(arr) - 1)])
+		return "".join(buf)
+
+	## Report that generation k was derived.
+	def report(self, k):
+		if self.progress is not None:
+			self.progress.report("generations", k)
+
+	## Expand the sentence n generations.
+	#  @param n - number of generations
+	#  @param sentence - initial sentence - base for the rule applications, a string or an EncodedSentence
+	#  @return the derived sentence, of the same type
+	def build(self, n, sentence):
+		if self.cache is not None and not self.stochastic and isinstance(sentence, str):
+			expansions = self.expansions(n)
+			return "".join([expansions.get(c, c) for c in sentence])
+		for i in range(n):
+			sentence = self.step(sentence)
+			self.report(i + 1)
+		return sentence
+
+	## Return the expansion of every rule predecessor after n generations.
+	#  The expansions are computed bottom-up, one generation at a time, and each (symbol, depth)
+	#  pair is looked up in the cache before being assembled from the expansions of the previous generation.
+	#  @param n - number of generations
+	#  @return a dictionary mapping each predecessor to its derived string
+	def expansions(self, n):
+		cache = self.cache
+		level = {}
+		for k in range(1, n + 1):
+			nextLevel = {}
+			for c, successor in self.rules.items():
+				key = (c, k, self.key)
+				expansion = cache.get(key)
+				if expansion is None:
+					expansion = "".join([level.get(x, x) for x in successor])
+					cache.put(key, expansion)
+				nextLevel[c] = expansion
+			level = nextLevel
+			self.report(k)
+		return level
+
+	## Expand the sentence n generations depth-first, yielding one symbol at a time.
+	#  Only one iterator per generation is alive at any moment, so the memory used is proportional
+	#  to n times the length of the rules instead of the length of the derived sentence.
+	#  @param n - number of generations
+	#  @param sentence - initial sentence - base for the rule applications
+	#  @return a generator over the symbols of the derived sentence
+	def stream(self, n, sentence):
+		rewrite = self.rewrite
+		stack = [(iter(sentence), n)]
+		while stack:
+			symbols, depth = stack[-1]
+			for c in symbols:
+				if depth > 0:
+					successor = rewrite(c)
+					if successor is not None:
+						stack.append((iter(successor), depth - 1))
+						break
+				yield c
+			else:
+				stack.pop()
+
+## Keeps every generation of a derivation, so that changing only the depth costs at most one generation per step.
+#
+#  Going one generation deeper rewrites the last generation kept, and going back to a smaller depth
+#  returns a generation kept before. For stochastic derivations the random choices made for the kept
+#  generations are reused, so a deeper tree grows out of the shallower one.
+#
+#  Example usage:
+#  - g = Generations(Derivation({'F':"F[+F]F[-F]F"}), "F")
+#  - g.get(4)  -> derives generations 1 to 4
+#  - g.get(5)  -> derives generation 5 only
+#  - g.get(3)  -> no derivation
+class Generations():
+
+	## Constructor.
+	#  @param derivation - the Derivation producing the generations
+	#  @param sentence - initial sentence
+	#  @param origin - any value identifying how the derivation started, e.g. the state of its random number generator
+	#  @param encoded - whether to keep EncodedSentence generations instead of strings
+	def __init__(self, derivation, sentence, origin=None, encoded=False):
+		self.derivation = derivation
+		self.sentence = sentence
+		self.origin = origin
+		self.encoded = encoded
+		## Generations kept so far. The first one is the initial sentence.
+		self.generations = [derivation.encode(sentence) if encoded else sentence]
+		## Depth of the last generation returned by get, or None.
+		self.last = None
+
+	## Return whether these generations derive the given sentence with the given derivation rules.
+	def matches(self, derivation, sentence):
+		d = self.derivation
+		return (sentence == self.sentence and derivation.stochastic == d.stochastic and
+				derivation.rules == d.rules and derivation.sRules == d.sRules)
+
+	## Return the number of generations kept, not counting the initial sentence.
+	def depth(self):
+		return len(self.generations) - 1
+
+	## Return generation n, deriving only the generations not kept yet.
+	#  @param n - number of generations
+	def get(self, n):
+		while len(self.generations) <= n:
+			self.generations.append(self.derivation.step(self.generations[-1]))
+			self.derivation.report(len(self.generations) - 1)
+		self.last = n
+		return self.generations[n]
+
+	## Return the number of characters kept.
+	def size(self):
+		return sum(len(g) for g in self.generations)
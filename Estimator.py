@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# Predicts the size of an L-System model before it is generated.
+# The number of times each symbol appears in every generation is computed from the growth matrix of the rules,
+# so the cost of a rule can be checked without expanding its sentence.
+#
+
+from __future__ import division
+
+## Approximate number of bytes in the scad file for each cylinder.
+SCAD_BYTES_PER_SEGMENT = 380
+## Approximate number of extra bytes in the scad file when a sphere is added to a cylinder.
+SCAD_BYTES_PER_SPHERE = 40
+## Approximate number of bytes in the scad file for each flower.
+SCAD_BYTES_PER_LEAF = 600
+## Approximate number of bytes of memory used by the SolidPython objects of each node.
+MEMORY_BYTES_PER_NODE = 2400
+
+## Raised by BuildTree when the estimated cost of a rule exceeds the configured budget.
+class BudgetExceeded(Exception):
+	pass
+
+## Computes exact symbol counts per generation of an L-System rule.
+#
+#  The growth matrix M has one row per symbol, where M[c][x] is the number of times x appears in the successor of c.
+#  Symbols without a rule map to themselves. The counts of generation k+1 are the counts of generation k times M.
+#  For stochastic rules every alternative is considered equally likely and the counts are expected values.
+#
+#  Example usage:
+#  - e = Estimator(Rules().TwoDTree1())
+#  - e.estimate()["segments"]  -> 3125
+class Estimator():
+
+	## Constructor.
+	#  @param rule - an LSysObj
+	#  @param stochastic - whether the stochastic rules are going to be used
+	#  @param spheres - whether spheres are going to be added between the cylinders
+	def __init__(self, rule, stochastic=False, spheres=False):
+		self.rule = rule
+		self.stochastic = stochastic
+		self.spheres = spheres
+		self.matrix = self.growthMatrix()
+
+	## Return the growth matrix of the rules as a dictionary of dictionaries of counts.
+	def growthMatrix(self):
+		if self.stochastic:
+			rules = dict((k, v) for k, v in self.rule.rulesStochastic.items() if len(k) == 1 and len(v) > 0)
+		else:
+			rules = dict((k, [v]) for k, v in self.rule.rules.items() if len(k) == 1)
+
+		symbols = set(self.rule.sentence)
+		for k, arr in rules.items():
+			symbols.add(k)
+			for v in arr:
+				symbols.update(v)
+
+		m = {}
+		for c in symbols:
+			if c not in rules:
+				m[c] = {c: 1}
+				continue
+			arr = rules[c]
+			row = {}
+			for v in arr:
+				for x in v:
+					row[x] = row.get(x, 0) + 1
+			if len(arr) > 1:
+				row = dict((x, n / len(arr)) for x, n in row.items())
+			m[c] = row
+		return m
+
+	## Return the symbol counts of the given generation.
+	#  @param counts - a dictionary with the number of times each symbol appears in the current generation
+	def step(self, counts):
+		nextCounts = {}
+		for c, n in counts.items():
+			for x, k in self.matrix[c].items():
+				nextCounts[x] = nextCounts.get(x, 0) + n * k
+		return nextCounts
+
+	## Return a list with the symbol counts of every generation, from the base sentence to generation n.
+	#  @param n - number of generations, defaults to the rule iterations
+	def generations(self, n=None):
+		if n is None:
+			n = self.rule.iterations
+		counts = {}
+		for c in self.rule.sentence:
+			counts[c] = counts.get(c, 0) + 1
+		result = [counts]
+		for i in range(n):
+			counts = self.step(counts)
+			result.append(counts)
+		return result
+
+	## Return the symbol counts after n generations.
+	#  @param n - number of generations, defaults to the rule iterations
+	def counts(self, n=None):
+		return self.generations(n)[-1]
+
+	## Return the predicted cost of generating the model.
+	#  - length - number of symbols of the derived sentence
+	#  - segments - number of cylinders (F and f)
+	#  - brackets - number of branches ([)
+	#  - leaves - number of flowers (L)
+	#  - nodes - number of nodes added to the model
+	#  - memory - bytes used by the sentence and the model nodes
+	#  - scadSize - bytes of the generated scad file
+	#  @param n - number of generations, defaults to the rule iterations
+	def estimate(self, n=None):
+		counts = self.counts(n)
+		length = sum(counts.values())
+		segments = counts.get('F', 0) + counts.get('f', 0)
+		leaves = counts.get('L', 0)
+		nodes = segments + leaves
+
+		segmentBytes = SCAD_BYTES_PER_SEGMENT + (SCAD_BYTES_PER_SPHERE if self.spheres else 0)
+		return {"length": length,
+				"segments": segments,
+				"brackets": counts.get('[', 0),
+				"leaves": leaves,
+				"nodes": nodes,
+				"memory": length + nodes * MEMORY_BYTES_PER_NODE,
+				"scadSize": segments * segmentBytes + leaves * SCAD_BYTES_PER_LEAF}
@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# Level of detail of the exported models.
+#
+# A single $fn for the whole model gives the thinnest twigs as many facets as the trunk.
+# A level of detail chooses the number of fragments of each cylinder from its radius,
+# so that the facets are about the same size everywhere, and drops the cylinders too thin or too short to be seen.
+#
+
+import numpy as np
+
+## Describes how detailed a model is.
+#
+#  Example usage:
+#  - lod = LevelOfDetail(edge=1, minFn=5, maxFn=48, minRadius=0.2)
+#  - lod.fragments(store.radii())  -> $fn of each row
+#  - lod.cull(store)  -> number of rows removed
+class LevelOfDetail(object):
+
+	## Constructor.
+	#  @param edge largest length of a facet along the circumference, in model units.
+	#  @param minFn smallest number of fragments.
+	#  @param maxFn largest number of fragments.
+	#  @param minRadius cylinders thinner than this are removed.
+	#  @param minLength cylinders shorter than this are removed.
+	def __init__(self, edge=1.0, minFn=5, maxFn=48, minRadius=0.0, minLength=0.0):
+		self.edge = edge
+		self.minFn = minFn
+		self.maxFn = maxFn
+		self.minRadius = minRadius
+		self.minLength = minLength
+
+	## Return the number of fragments ($fn) of circles with the given radii.
+	#  @param radii array of radii.
+	def fragments(self, radii):
+		fn = np.ceil(2 * np.pi * np.asarray(radii, dtype=float) / self.edge)
+		return np.clip(fn, self.minFn, self.maxFn).astype(int)
+
+	## Remove the cylinders thinner than minRadius or shorter than minLength. The flowers are kept.
+	#  @param store a SegmentStore, changed in place.
+	#  @return the number of rows removed.
+	def cull(self, store):
+		small = ~store.leaves() & ((store.radii() < self.minRadius) | (store.lengths() < self.minLength))
+		removed = int(small.sum())
+		if removed > 0:
+			store.compact(np.nonzero(~small)[0])
+		return removed
+
+## Levels of detail selected by name.
+#  - preview - coarse facets and no thin twigs, quick to open in OpenSCAD
+#  - print - fine facets, for the smallest details a printer can reproduce
+LEVELS = {"preview": LevelOfDetail(edge=2.0, minFn=5, maxFn=16, minRadius=0.3, minLength=0.5),
+		  "print": LevelOfDetail(edge=0.5, minFn=8, maxFn=64)}
+
+## A store sink that removes the rows culled by a level of detail before handing the rows over to another sink.
+class Culler(object):
+
+	## Constructor.
+	#  @param lod a LevelOfDetail.
+	#  @param sink function called with the store after the culling, or None.
+	def __init__(self, lod, sink=None):
+		self.lod = lod
+		self.sink = sink
+		## Number of rows removed so far.
+		self.removed = 0
+
+	## Cull the rows of a store and hand them over to the sink.
+	def __call__(self, store):
+		self.removed += self.lod.cull(store)
+		if self.sink is not None:
+			self.sink(store)
@@ -13,18 +13,45 @@
 import matrix
 import numpy as np
 import random
+from Derivation import Derivation, DerivationCache, Generations, EncodedSentence
+from Compiler import compileSentence, tokenize, interpret, streamEncoded
 # Assumes SolidPython is in site-packages or elsewhwere in sys.path
 from solid import *
 from solid.utils import *
 from turtle import turtle
+from BatchTurtle import BatchTurtle
+from ParallelTurtle import ParallelTurtle
+from Brackets import BracketIndex
+from SegmentStore import SegmentStore
+from Optimize import mergeCollinear
 
 class LSystem():
 	
 	def __init__(self):
 		self.stochastic = False
 		self.spheres = False
+		self.streaming = False
+		self.batch = False
+		## Number of processes interpreting the top-level branches of a batch program, or None for a single process.
+		self.workers = None
+		## Branches nested deeper than this are not drawn, or None to draw every branch.
+		self.pruneDepth = None
+		## Whether the derived sentences are EncodedSentence byte arrays instead of strings.
+		self.encoded = False
+		## Size in bytes above which the derived generations are spilled to disk, or None to keep them in memory.
+		self.spillThreshold = None
+		self.spillDirectory = None
 		self.debug = False
+		self.merge = False
 		self.turtle = turtle()
+		## Expansions shared by every deterministic derivation built by this object.
+		self.cache = DerivationCache()
+		## Random number generator of the stochastic rules and of the leaf colors.
+		self.rng = random.Random()
+		## Generations of the last stochastic or encoded derivation, reused when only the depth changes.
+		self.generations = None
+		## Progress.Progress told about the generations derived and the segments drawn, or None.
+		self.progress = None
 	
 	def printDebug(self, state):
 		self.debug = state
@@ -35,6 +62,65 @@ class LSystem():
 	def useSpheres(self, state):
 		self.spheres = state
 
+	## Seeds the random number generator, so that the stochastic trees can be reproduced.
+	#  The kept generations were drawn with the previous state and are dropped.
+	def seed(self, seed):
+		self.rng.seed(seed)
+		self.generations = None
+
+	## Returns the state of the random number generator, which can be pickled.
+	def getState(self):
+		return self.rng.getstate()
+
+	## Restores a state returned by getState, possibly after a round trip through json.
+	def setState(self, state):
+		version, internal, gauss = state
+		self.rng.setstate((version, tuple(internal), gauss))
+		self.generations = None
+
+	## Sets the Progress.Progress told about the generations derived and the segments drawn, or None.
+	def setProgress(self, progress):
+		self.progress = progress
+
+	## Sets whether the compiled program is interpreted all at once by a BatchTurtle.
+	def useBatch(self, state):
+		self.batch = state
+
+	## Sets the number of processes interpreting the top-level branches of the batch programs.
+	#  None interprets them in this process.
+	#  @see ParallelTurtle
+	def setWorkers(self, workers):
+		self.workers = workers
+
+	## Sets the deepest branch nesting drawn, 0 drawing only the trunk, or None to draw every branch.
+	#  Only compiled programs are pruned, streamed sentences are drawn whole.
+	def setPruneDepth(self, depth):
+		self.pruneDepth = depth
+
+	## Sets whether the sentences are derived as EncodedSentence byte arrays, rewritten with NumPy,
+	#  instead of strings. The derived trees are the same.
+	def useEncoded(self, state):
+		self.encoded = state
+
+	## Sets the size in bytes above which a derived generation is written to a memory mapped file instead of
+	#  being kept in memory, so that the depth of a derivation is bounded by the disk. The sentences are then
+	#  always encoded, see useEncoded, and the turtle reads spilled sentences from disk a chunk at a time.
+	#  @param threshold - size in bytes, or None to keep every generation in memory
+	#  @param directory - directory of the spilled files, or None for the default temporary directory
+	def setSpill(self, threshold, directory=None):
+		self.spillThreshold = threshold
+		self.spillDirectory = directory
+		self.generations = None
+
+	## Sets whether consecutive collinear cylinders are fused into a single cylinder.
+	#  @see Optimize.mergeCollinear
+	def useMerge(self, state):
+		self.merge = state
+
+	## Sets whether the derived sentence is streamed to draw symbol by symbol instead of being built first.
+	def useStreaming(self, state):
+		self.streaming = state
+
 	## L-Systems were developed as a mathematical description of plant growth designed to model biological systems.
 	#  L-Systems can be thought as containing the instructions for how a single cell can grow into a complex organism.
 	#  They can be used to define the rules for interesting patterns, being particularly useful for fractal creation.s
@@ -47,34 +133,52 @@ class LSystem():
 	#  @param n - height of tree
 	#  @param sentence - initial sentence - base for the rule applications
 	#  @param rules - a dictionary containing an axiom:rule key:value pair, they're both expected to be strings
+	#  @param sRules - a dictionary containing an axiom:[rules] key:value pair used by stochastic derivations
 	#  @return the resulting L-System based off of the given axioms and rules
+	#
+	#  Deterministic string derivations reuse the expansions of the cache, so a new depth only assembles the
+	#  generations not derived yet. Encoded deterministic derivations keep their generations instead, since
+	#  the cache holds strings. Stochastic derivations keep their generations while the rules and the
+	#  sentence stay the same and the depth changes: a deeper tree is derived from the deepest one kept
+	#  and a shallower tree is one of the kept generations. Asking again for the depth of the last tree
+	#  draws a new tree.
+	#  @see Derivation
+	#  @see Generations
 	def buildLSystem(self, n, sentence, rules, sRules):
-		next = ""
-		
-		if (n > 0):
-			characters = list(sentence)
-			
-			for c in characters:
-				if (not self.stochastic and c in rules):
-					next += self.buildLSystem(n-1, rules[c], rules, sRules)
-				elif (self.stochastic and c in sRules):
-					arr = sRules[c]
-					#						half = int(len(rule)/2)
-					#						ruleH1 = rule[0:half + 1]
-					#						ruleH2 = rule[(half):]
-					
-					sel = random.randint(0, len(arr) - 1)
-					#						arr = [rule, ruleH1, ruleH2]
-					selectedRule = arr[sel]
-					
-					next += self.buildLSystem(n-1, selectedRule, rules, sRules)
-				else:
-					next += c
+		derivation = Derivation(rules, sRules, self.stochastic, self.rng, self.cache, self.progress)
+		derivation.setSpill(self.spillThreshold, self.spillDirectory)
+		encoded = self.encoded or self.spillThreshold is not None
+		if not self.stochastic and not encoded:
+			return derivation.build(n, sentence)
+		if not self.reusesGenerations(n, derivation, sentence, encoded):
+			self.generations = Generations(derivation, sentence, self.rng.getstate(), encoded)
+		return self.generations.get(n)
 
-		else:
-			return sentence
-		
-		return next
+	## Returns whether the kept generations are reused to derive a tree of depth n.
+	#  @param n - height of tree
+	#  @param derivation - the Derivation of the tree
+	#  @param sentence - initial sentence
+	#  @param encoded - whether the tree is an EncodedSentence
+	def reusesGenerations(self, n, derivation, sentence, encoded):
+		g = self.generations
+		if g is None or not g.matches(derivation, sentence) or g.encoded != encoded:
+			return False
+		return not self.stochastic or n != g.last
+
+	## Returns what a stochastic derivation depends on besides the rules and the state of the random
+	#  number generator: the state the kept generations started from and how many of them are reused.
+	#  Returns None when no kept generation is reused.
+	#  @param n - height of tree
+	#  @param sentence - initial sentence
+	#  @param rules - a dictionary containing an axiom:rule key:value pair
+	#  @param sRules - a dictionary containing an axiom:[rules] key:value pair
+	def generationsKey(self, n, sentence, rules, sRules):
+		if not self.stochastic or self.streaming:
+			return None
+		encoded = self.encoded or self.spillThreshold is not None
+		if not self.reusesGenerations(n, Derivation(rules, sRules, True), sentence, encoded) or self.generations.depth() == 0:
+			return None
+		return (self.generations.origin, min(n, self.generations.depth()))
 
 
 	## Interpret a given sentence and draw the result.
@@ -96,31 +200,108 @@ class LSystem():
 	#  - < Increment cylinder diameter by hardcoded percentage
 	#  - ( ) Consider value between parenthesis for next command
 	#  - L Add "leaves"
-	#  @param lSentence - the L-System string returned by buildLSystem
+	#
+	#  The sentence is compiled into an opcode array once and the opcodes are run by a dispatch loop.
+	#  A sentence that is not a string (e.g. a streamed derivation) is compiled lazily, one symbol at a time.
+	#  @param lSentence - the L-System string returned by buildLSystem, or any iterable of symbols
 	#  @param angle - angle of rotation
 	#  @param d - length d
+	#  @see Compiler
 	def draw(self, col, lSentence, angle, d):
-		characters = list(lSentence)
-		stack = []
-		
-		a = 0
-		accumAngle = ""
-		finishedAccumAng = False
-		
-		t = turtle(h=d)
+		return self.execute(col, self.compile(lSentence, angle), d)
+
+	## Compile a sentence into a program for execute.
+	#  @param lSentence - the L-System string returned by buildLSystem, or any iterable of symbols
+	#  @param angle - angle of rotation
+	#  @return a tuple (ops, args), or a generator of (opcode, argument) pairs for a streamed or spilled sentence
+	def compile(self, lSentence, angle):
+		if isinstance(lSentence, EncodedSentence) and lSentence.spilled() and not self.batch:
+			return streamEncoded(lSentence, angle)
+		if isinstance(lSentence, (str, EncodedSentence)) or self.batch:
+			return compileSentence(lSentence, angle)
+		return tokenize(lSentence, angle)
+
+	## Run a compiled program and draw the result.
+	#  @param program - a tuple (ops, args) returned by compileSentence, or an iterable of (opcode, argument) pairs
+	#  @param d - length d
+	def execute(self, col, program, d):
+		return self.segments(col, program, d).toSolid()
+
+	## Run a compiled program and return the drawn nodes.
+	#  @param program - a tuple (ops, args) returned by compileSentence, or an iterable of (opcode, argument) pairs
+	#  @param d - length d
+	#  @param store - SegmentStore to draw into, or None to create a new one
+	#  @return a SegmentStore with the cylinders and flowers
+	def segments(self, col, program, d, store=None):
+		if store is None:
+			store = SegmentStore()
+		program = self.prune(program)
+		if self.batch:
+			if self.workers:
+				t = ParallelTurtle(col=col if col != "" else None, rounded=self.spheres, store=store, rng=self.rng,
+								   workers=self.workers)
+			else:
+				t = BatchTurtle(col=col if col != "" else None, rounded=self.spheres, store=store, rng=self.rng)
+			t.run(program, d)
+		elif self.progress is not None:
+			t = self.createTurtle(col, d, store)
+			interpret(t, program, d, lambda: self.progress.report("segments", store.total()), self.progress.INTERVAL)
+		else:
+			t = self.createTurtle(col, d, store)
+			interpret(t, program, d)
+		if self.progress is not None:
+			self.progress.report("segments", store.total())
+		return store
+
+	## Return a compiled program without the branches deeper than pruneDepth, printing the branch statistics in debug mode.
+	#  @param program - a tuple (ops, args) returned by compileSentence, or an iterable of (opcode, argument) pairs
+	def prune(self, program):
+		if not isinstance(program, tuple) or (self.pruneDepth is None and not self.debug):
+			return program
+		ops = np.frombuffer(program[0], dtype=np.uint8) if hasattr(program[0], "typecode") else np.asarray(program[0], dtype=np.uint8)
+		index = BracketIndex(ops)
+		if self.debug:
+			print("Branches: " + str(index.stats()))
+		if self.pruneDepth is None:
+			return program
+		keep = index.prune(self.pruneDepth)
+		print("Pruned opcodes: " + str(len(ops) - int(keep.sum())))
+		return ops[keep], np.asarray(program[1], dtype=float)[keep]
+
+	## Return a new turtle set up with the current options.
+	#  @param col - pen color, or an empty string to keep the turtle default colors
+	#  @param d - length d
+	#  @param store - SegmentStore to write the nodes into, or None to create openscad primitives
+	def createTurtle(self, col, d, store=None):
+		t = turtle(h=d, store=store, rng=self.rng)
 		# Set whether to add spheres between cylinders
 		t.setRounded(rd = self.spheres)
 		# Set whether to print the debug log
 		t.setDebug(self.debug)
 		# Set a pencolor
-		if col is not "":
+		if col != "":
 			t.pencolor(col);
+		return t
+
+	## Interpret a given sentence one character at a time and draw the result.
+	#  This is the reference implementation of draw, used to validate and benchmark the compiled interpreter.
+	#  @param lSentence - the L-System string returned by buildLSystem, or any iterable of symbols
+	#  @param angle - angle of rotation
+	#  @param d - length d
+	def drawCharacters(self, col, lSentence, angle, d):
+		stack = []
+		
+		a = 0
+		accumAngle = ""
+		finishedAccumAng = False
+		
+		t = self.createTurtle(col, d)
 		# Percentage of cylinder reduction
 		percentReduction = 0.20
 		# Increase cylinder height by 30%
 		cylScale = 1.3
 		
-		for c in characters:
+		for c in lSentence:
 			a = int(accumAngle) if (accumAngle is not '') else angle
 			
 			if (c == 'F' or c == 'f'):
@@ -198,8 +379,26 @@ class LSystem():
 	#  @param d - step distance
 	#  @param rules - a dictionary containing an axiom:rule key:value pair, they're both expected to be strings
 	def lSystem(self, col, n, sentence, a, d, rules, sRules):
+		return self.lSystemSegments(col, n, sentence, a, d, rules, sRules).toSolid()
+
+	## Generate the fractal resulting from the following parameters, without creating openscad primitives.
+	#  When merging is on, the collinear cylinders of a store without a sink are fused. A store with a sink
+	#  hands its rows over as they are drawn, so its sink must do the merge, e.g. Optimize.CollinearMerger.
+	#  @param store - SegmentStore to draw into, or None to create a new one
+	#  @return a SegmentStore with the cylinders and flowers
+	#  @see lSystem
+	def lSystemSegments(self, col, n, sentence, a, d, rules, sRules, store=None):
 		print("Selected rule:")
 		print("Angle: " + str(a))
+		lSentence = self.derive(n, sentence, rules, sRules)
+		store = self.segments(col, self.compile(lSentence, a), d, store)
+		if self.merge and store.sink is None:
+			print("Merged segments: " + str(mergeCollinear(store)))
+		return store
+
+	## Print the rule and return its derived sentence, streamed or fully built according to the options.
+	#  @see lSystem
+	def derive(self, n, sentence, rules, sRules):
 		print("Depth: " + str(n))
 		print("Base Sentence: " + sentence)
 
@@ -207,9 +406,19 @@ class LSystem():
 			print(sRules)
 		else:
 			print(rules)
+		length = Derivation(rules, sRules, self.stochastic).length(n, sentence)
+		if length is not None:
+			print("Sentence length: " + str(length))
 		print ("")
-		lSentence = self.buildLSystem(n, sentence, rules, sRules)
-		return self.draw(col, lSentence, a, d)
+		if self.streaming:
+			lSentence = Derivation(rules, sRules, self.stochastic, self.rng).stream(n, sentence)
+		else:
+			lSentence = self.buildLSystem(n, sentence, rules, sRules)
+			if self.debug:
+				print("Derivation cache: " + str(self.cache.stats()))
+				if self.generations is not None:
+					print("Generations kept: %d (%d symbols)" % (self.generations.depth(), self.generations.size()))
+		return lSentence
 
 ## Silly test that draws a bunch of cylinders.
 def test(d):
@@ -0,0 +1,316 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# Builds a single watertight surface for the skeleton of a tree, without OpenSCAD.
+#
+# Every cylinder of a SegmentStore becomes a capsule (a tube capped by half spheres) around its axis,
+# so the tubes are joined at the branch nodes and rounded at the tips, and every flower becomes four spheres.
+# The signed distance to the union of these shapes is sampled on a voxel grid, and its zero level set is
+# extracted by marching tetrahedra. Neighbouring cells share the vertices of their common edges,
+# so the result is a closed, oriented, 2-manifold mesh which can be printed as is.
+#
+# @see https://en.wikipedia.org/wiki/Marching_tetrahedra
+# @see https://iquilezles.org/articles/distfunctions/
+#
+
+from __future__ import division
+
+import numpy as np
+
+from Mesh import StlWriter, FLOWER_OFFSETS
+
+## Maximum number of grid cells sampled. The voxel size is increased to stay below it.
+MAX_CELLS = 1 << 25
+
+## Maximum number of grid cells polygonized at once.
+CHUNK_CELLS = 1 << 16
+
+## Smallest distance from a vertex to the ends of its grid edge, as a fraction of the edge.
+#  Vertices on different edges stay apart after being rounded to the single precision of stl files.
+MIN_T = 0.01
+
+## Corners of a grid cell, indexed by dx + 2 * dy + 4 * dz.
+CORNERS = np.array([(i & 1, (i >> 1) & 1, (i >> 2) & 1) for i in range(8)])
+
+## Split of a cell into six tetrahedra around its main diagonal, from corner 0 to corner 7.
+#  Every cell is split the same way, so the faces of neighbouring tetrahedra match.
+TETRAHEDRA = np.array([(0, 1, 3, 7), (0, 1, 5, 7), (0, 2, 3, 7), (0, 2, 6, 7), (0, 4, 5, 7), (0, 4, 6, 7)])
+
+## Return the triangles of each of the 16 cases of a tetrahedron, as edges between its vertices.
+#  The case of a tetrahedron has bit i set when its vertex i is inside.
+#  @return a tuple (edges, valid) of (16,2,3,2) and (16,2) arrays: up to two triangles of three edges per case.
+def buildCases():
+	edges = np.zeros((16, 2, 3, 2), dtype=np.int64)
+	valid = np.zeros((16, 2), dtype=bool)
+	for case in range(16):
+		inside = [i for i in range(4) if case >> i & 1]
+		outside = [i for i in range(4) if not case >> i & 1]
+		if len(inside) in (1, 3):
+			p = inside[0] if len(inside) == 1 else outside[0]
+			edges[case, 0] = [(p, q) for q in range(4) if q != p]
+			valid[case, 0] = True
+		elif len(inside) == 2:
+			a, b = inside
+			c, d = outside
+			edges[case, 0] = [(a, c), (a, d), (b, d)]
+			edges[case, 1] = [(a, c), (b, d), (b, c)]
+			valid[case] = True
+	return edges, valid
+
+CASE_EDGES, CASE_VALID = buildCases()
+
+## Return the distance from points to capped cones along the z axis, from z = 0 to z = h.
+#  @param x, y, z coordinates of the points, in the frame of the cone.
+#  @param r1 bottom radius.
+#  @param r2 top radius.
+#  @param h height.
+def coneDistance(x, y, z, r1, r2, h):
+	qx = np.sqrt(x * x + y * y)
+	qy = z - h / 2
+	hh = h / 2
+	# Distance to the caps.
+	cax = qx - np.minimum(qx, np.where(qy < 0, r1, r2))
+	cay = np.abs(qy) - hh
+	# Distance to the slanted side.
+	k2x, k2y = r2 - r1, 2 * hh
+	t = np.clip(((r2 - qx) * k2x + (hh - qy) * k2y) / (k2x * k2x + k2y * k2y), 0, 1)
+	cbx = qx - r2 + k2x * t
+	cby = qy - hh + k2y * t
+	s = np.where((cbx < 0) & (cay < 0), -1.0, 1.0)
+	return s * np.sqrt(np.minimum(cax * cax + cay * cay, cbx * cbx + cby * cby))
+
+## Return the vertices and faces of the zero level set of a signed distance field.
+#  @param field (nx,ny,nz) array of distances, negative inside. The values on the border must be positive.
+#  @param origin position of the sample field[0,0,0].
+#  @param voxel distance between samples.
+#  @return a tuple (vertices, faces) of (V,3) float and (F,3) int arrays, with counterclockwise faces seen from outside.
+def marchingTetrahedra(field, origin, voxel):
+	shape = field.shape
+	values = field.ravel()
+	inside = field < 0
+
+	# Only the cells with corners on both sides cross the surface.
+	cellShape = tuple(n - 1 for n in shape)
+	anyIn = np.zeros(cellShape, dtype=bool)
+	allIn = np.ones(cellShape, dtype=bool)
+	for dx, dy, dz in CORNERS:
+		corner = inside[dx:dx + cellShape[0], dy:dy + cellShape[1], dz:dz + cellShape[2]]
+		anyIn |= corner
+		allIn &= corner
+	cells = np.argwhere(anyIn & ~allIn)
+	del anyIn, allIn
+
+	strides = np.array([shape[1] * shape[2], shape[2], 1])
+	cornerOffsets = CORNERS.dot(strides)
+	origin = np.asarray(origin, dtype=float)
+
+	def position(ids):
+		return np.stack(np.unravel_index(ids, shape), axis=-1) * voxel + origin
+
+	def crossing(a, b):
+		va, vb = values[a], values[b]
+		t = np.clip(va / (va - vb), MIN_T, 1 - MIN_T)
+		return position(a) + (position(b) - position(a)) * t[..., None]
+
+	n = values.size
+	keys = []
+	for start in range(0, len(cells), CHUNK_CELLS):
+		base = cells[start:start + CHUNK_CELLS].dot(strides)
+		ids = (base[:, None] + cornerOffsets[None])[:, TETRAHEDRA].reshape(-1, 4)
+		isIn = values[ids] < 0
+		case = isIn.dot(np.array([1, 2, 4, 8]))
+		corners = position(ids)
+		insideCenter = (corners * isIn[..., None]).sum(axis=1) / np.maximum(isIn.sum(axis=1), 1)[:, None]
+
+		for slot in range(2):
+			selected = np.nonzero(CASE_VALID[case, slot])[0]
+			edges = CASE_EDGES[case[selected], slot]
+			tet = ids[selected]
+			a = np.take_along_axis(tet, edges[..., 0], axis=1)
+			b = np.take_along_axis(tet, edges[..., 1], axis=1)
+
+			# Orient each triangle so that its normal points away from the inside corners of its tetrahedron.
+			p = crossing(a, b)
+			normal = np.cross(p[:, 1] - p[:, 0], p[:, 2] - p[:, 0])
+			flip = np.einsum("ij,ij->i", normal, insideCenter[selected] - p[:, 0]) > 0
+
+			key = np.minimum(a, b) * n + np.maximum(a, b)
+			key[flip] = key[flip][:, ::-1]
+			keys.append(key)
+
+	if not keys:
+		return np.empty((0, 3)), np.empty((0, 3), dtype=np.int64)
+
+	# Triangles sharing an edge of the grid share the vertex on that edge.
+	unique, faces = np.unique(np.concatenate(keys), return_inverse=True)
+	faces = faces.reshape(-1, 3)
+	vertices = crossing(unique // n, unique % n)
+	return vertices, faces
+
+## Builds a watertight mesh from capsules, spheres and cones.
+#
+#  Example usage:
+#  - b = ManifoldBuilder(voxel=0.5)
+#  - b.addStore(store)
+#  - vertices, faces = b.build()
+#  - b.writeStl(f)
+class ManifoldBuilder(object):
+
+	## Constructor.
+	#  @param voxel distance between the samples of the grid, or None to use half the smallest radius.
+	#  @param maxCells maximum number of grid cells. The voxel size is increased to stay below it.
+	def __init__(self, voxel=None, maxCells=MAX_CELLS):
+		self.voxel = voxel
+		self.maxCells = maxCells
+		## Start points, end points and radii of the capsules.
+		self.starts = []
+		self.ends = []
+		self.radii = []
+		## Cones given as (transform, bottom radius, top radius, height).
+		self.cones = []
+		self.vertices = None
+		self.faces = None
+
+	## Add capsules. A sphere is a capsule whose ends are the same point.
+	#  @param starts (K,3) start points.
+	#  @param ends (K,3) end points.
+	#  @param radii (K,) radii.
+	def addCapsules(self, starts, ends, radii):
+		self.starts.append(np.asarray(starts, dtype=float).reshape(-1, 3))
+		self.ends.append(np.asarray(ends, dtype=float).reshape(-1, 3))
+		self.radii.append(np.asarray(radii, dtype=float).reshape(-1))
+
+	## Add the nodes of a store: a capsule per cylinder, and four spheres per flower.
+	#  @param store a SegmentStore.
+	#  @param transform 4x4 matrix applied to every node, or None.
+	def addStore(self, store, transform=None):
+		transforms = store.transforms()
+		if transform is not None:
+			transforms = np.matmul(np.asarray(transform, dtype=float), transforms)
+		leaves = store.leaves()
+		radii = store.radii()
+
+		cylinders = transforms[~leaves]
+		starts = cylinders[:, :3, 3]
+		ends = starts + cylinders[:, :3, 2] * store.lengths()[~leaves][:, None]
+		self.addCapsules(starts, ends, radii[~leaves])
+
+		flowers = transforms[leaves]
+		for offset in FLOWER_OFFSETS:
+			centers = np.einsum("kij,j->ki", flowers[:, :3, :3], offset) + flowers[:, :3, 3]
+			self.addCapsules(centers, centers, radii[leaves])
+
+	## Add a capped cone along the z axis of the given transform.
+	#  @param transform 4x4 matrix placing the cone.
+	#  @param r1 bottom radius.
+	#  @param r2 top radius.
+	#  @param h height.
+	def addCone(self, transform, r1, r2, h):
+		self.cones.append((np.asarray(transform, dtype=float), r1, r2, h))
+
+	## Return the lower and upper corners of the box around every shape.
+	def bounds(self, starts, ends, radii):
+		lower, upper = [], []
+		if len(radii) > 0:
+			lower.append((np.minimum(starts, ends) - radii[:, None]).min(axis=0))
+			upper.append((np.maximum(starts, ends) + radii[:, None]).max(axis=0))
+		for m, r1, r2, h in self.cones:
+			corners = self.coneCorners(m, r1, r2, h)
+			lower.append(corners.min(axis=0))
+			upper.append(corners.max(axis=0))
+		return np.min(lower, axis=0), np.max(upper, axis=0)
+
+	## Return the corners of the box around a cone, in world coordinates.
+	def coneCorners(self, m, r1, r2, h):
+		r = max(r1, r2)
+		box = np.array([(x, y, z) for x in (-r, r) for y in (-r, r) for z in (0, h)])
+		return box.dot(m[:3, :3].T) + m[:3, 3]
+
+	## Return the voxel size: the requested one, or half the smallest radius, increased to fit maxCells.
+	def voxelSize(self, lower, upper, radii):
+		voxel = self.voxel
+		if voxel is None:
+			smallest = [radii.min()] if len(radii) > 0 else []
+			smallest += [max(r1, r2) for m, r1, r2, h in self.cones]
+			voxel = min(smallest) / 2
+		extent = upper - lower
+		cells = np.prod(extent / voxel + 4)
+		if cells > self.maxCells:
+			voxel *= (cells / self.maxCells) ** (1 / 3)
+		return voxel
+
+	## Sample the signed distance to the union of the shapes.
+	#  @return a tuple (field, origin, voxel)
+	def sample(self):
+		starts = np.concatenate(self.starts) if self.starts else np.empty((0, 3))
+		ends = np.concatenate(self.ends) if self.ends else np.empty((0, 3))
+		radii = np.concatenate(self.radii) if self.radii else np.empty(0)
+		if len(radii) == 0 and not self.cones:
+			raise ValueError("No shapes to mesh")
+
+		lower, upper = self.bounds(starts, ends, radii)
+		voxel = self.voxelSize(lower, upper, radii)
+		# Leave two samples of margin, so that the border of the grid is outside every shape.
+		origin = lower - 2 * voxel
+		shape = tuple(np.ceil((upper - origin) / voxel).astype(int) + 3)
+		field = np.full(shape, 2 * voxel, dtype=np.float32)
+		axes = [origin[i] + voxel * np.arange(shape[i]) for i in range(3)]
+
+		def window(lo, hi):
+			i0 = np.clip(np.floor((lo - origin) / voxel).astype(int), 0, np.array(shape) - 1)
+			i1 = np.clip(np.ceil((hi - origin) / voxel).astype(int) + 1, 1, np.array(shape))
+			sub = tuple(slice(i0[i], i1[i]) for i in range(3))
+			x = axes[0][sub[0]][:, None, None]
+			y = axes[1][sub[1]][None, :, None]
+			z = axes[2][sub[2]][None, None, :]
+			return sub, x, y, z
+
+		for a, b, r in zip(starts, ends, radii):
+			sub, x, y, z = window(np.minimum(a, b) - r - voxel, np.maximum(a, b) + r + voxel)
+			ba = b - a
+			length2 = ba.dot(ba)
+			px, py, pz = x - a[0], y - a[1], z - a[2]
+			if length2 > 0:
+				t = np.clip((px * ba[0] + py * ba[1] + pz * ba[2]) / length2, 0, 1)
+				px, py, pz = px - ba[0] * t, py - ba[1] * t, pz - ba[2] * t
+			d = np.sqrt(px * px + py * py + pz * pz) - r
+			np.minimum(field[sub], d, out=field[sub])
+
+		for m, r1, r2, h in self.cones:
+			corners = self.coneCorners(m, r1, r2, h)
+			sub, x, y, z = window(corners.min(axis=0) - voxel, corners.max(axis=0) + voxel)
+			# Bring the samples into the frame of the cone.
+			rot, t = m[:3, :3], m[:3, 3]
+			px, py, pz = x - t[0], y - t[1], z - t[2]
+			lx = rot[0, 0] * px + rot[1, 0] * py + rot[2, 0] * pz
+			ly = rot[0, 1] * px + rot[1, 1] * py + rot[2, 1] * pz
+			lz = rot[0, 2] * px + rot[1, 2] * py + rot[2, 2] * pz
+			np.minimum(field[sub], coneDistance(lx, ly, lz, r1, r2, h), out=field[sub])
+
+		# Keep every sample off the surface, so that no vertex lands on a grid point.
+		field[np.abs(field) < 1e-6 * voxel] = 1e-6 * voxel
+		return field, origin, voxel
+
+	## Build the mesh of the union of the shapes.
+	#  @return a tuple (vertices, faces)
+	def build(self):
+		field, origin, voxel = self.sample()
+		self.vertices, self.faces = marchingTetrahedra(field, origin, voxel)
+		return self.vertices, self.faces
+
+	## Write the mesh to a binary stl file.
+	#  @param f binary file object to write to.
+	def writeStl(self, f):
+		writer = StlWriter(f)
+		writer.begin()
+		writer.writeTriangles(self.vertices[self.faces])
+		writer.end()
+
+	## Write the mesh to a Wavefront obj file.
+	#  @param f text file object to write to.
+	def writeObj(self, f):
+		f.write("# %d vertices, %d faces\n" % (len(self.vertices), len(self.faces)))
+		np.savetxt(f, self.vertices, fmt="v %.6f %.6f %.6f")
+		np.savetxt(f, self.faces + 1, fmt="f %d %d %d")
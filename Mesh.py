@@ -0,0 +1,213 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# Tessellates the nodes of a SegmentStore and writes them to a binary STL file, without OpenSCAD.
+#
+# Every cylinder, sphere and flower is tessellated the way OpenSCAD does with the given $fn,
+# and transformed with NumPy. The shapes are not merged with a boolean union: the resulting file
+# has overlapping shells, which is fine for previewing and for most slicers.
+#
+# @see https://en.wikipedia.org/wiki/STL_(file_format)
+#
+
+from __future__ import division
+
+import struct
+import numpy as np
+
+## Record of a binary STL triangle: normal, three vertices and an attribute byte count.
+STL_TRIANGLE = np.dtype([("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attr", "<u2")])
+
+## Maximum number of triangles transformed at once.
+CHUNK_TRIANGLES = 1 << 18
+
+## Offsets of the four spheres of a flower.
+FLOWER_OFFSETS = [(0, 0.5, 0), (0, -0.5, 0), (0, 0, 0.5), (0, 0, -0.5)]
+
+## Return the points of a circle with the given radius and number of fragments, at height z.
+def circle(fn, r, z):
+	a = 2 * np.pi * np.arange(fn) / fn
+	return np.stack((r * np.cos(a), r * np.sin(a), np.full(fn, float(z))), axis=1)
+
+## Return the triangles of a solid of revolution given by its rings, from the bottom to the top.
+#  Consecutive rings are joined by bands of triangles and both ends are closed by a fan.
+#  Triangles with no area (e.g. at the tip of a cone) are dropped.
+#  @param fn number of fragments.
+#  @param rings list of (z, radius) pairs.
+#  @return (T,3,3) array of counterclockwise triangles, seen from the outside.
+def revolve(fn, rings):
+	points = [circle(fn, r, z) for z, r in rings]
+	j = np.arange(fn)
+	k = (j + 1) % fn
+	triangles = []
+	for lower, upper in zip(points[:-1], points[1:]):
+		triangles.append(np.stack((lower[j], lower[k], upper[k]), axis=1))
+		triangles.append(np.stack((lower[j], upper[k], upper[j]), axis=1))
+	fan = np.arange(1, fn - 1)
+	bottom, top = points[0], points[-1]
+	triangles.append(np.stack((bottom[np.zeros(fn - 2, dtype=int)], bottom[fan + 1], bottom[fan]), axis=1))
+	triangles.append(np.stack((top[np.zeros(fn - 2, dtype=int)], top[fan], top[fan + 1]), axis=1))
+	triangles = np.concatenate(triangles)
+
+	area = np.linalg.norm(np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]), axis=1)
+	return triangles[area > 1e-12]
+
+## Return the triangles of a cylinder or cone along the z axis, from z = 0 to z = h.
+#  @param fn number of fragments.
+#  @param r1 bottom radius.
+#  @param r2 top radius.
+#  @param h height.
+def cylinderTriangles(fn, r1=1.0, r2=1.0, h=1.0):
+	return revolve(fn, [(0, r1), (h, r2)])
+
+## Return the triangles of a sphere centered at the origin, with the rings OpenSCAD uses.
+#  @param fn number of fragments.
+#  @param r radius.
+def sphereTriangles(fn, r=1.0):
+	rings = (fn + 1) // 2
+	phi = np.pi * (np.arange(rings)[::-1] + 0.5) / rings
+	return revolve(fn, [(r * np.cos(p), r * np.sin(p)) for p in phi])
+
+## Return the triangles of a flower: four spheres around the origin.
+#  @param fn number of fragments.
+#  @param r sphere radius.
+def flowerTriangles(fn, r=1.0):
+	sphere = sphereTriangles(fn, r)
+	return np.concatenate([sphere + np.array(offset) for offset in FLOWER_OFFSETS])
+
+## Return the triangles transformed by a 4x4 matrix.
+def transformTriangles(triangles, m):
+	m = np.asarray(m)
+	return np.einsum("ij,tvj->tvi", m[:3, :3], triangles) + m[:3, 3]
+
+## Return the triangles of a binary or ascii STL file.
+#  @param path path of the file.
+#  @return (T,3,3) array of triangles.
+def readStl(path):
+	with open(path, "rb") as f:
+		data = f.read()
+	if len(data) >= 84:
+		count = struct.unpack("<I", data[80:84])[0]
+		if len(data) == 84 + count * STL_TRIANGLE.itemsize:
+			return np.frombuffer(data, dtype=STL_TRIANGLE, count=count, offset=84)["vertices"].astype(float)
+	vertices = [line.split()[1:4] for line in data.decode("ascii", "replace").splitlines() if line.strip().startswith("vertex")]
+	return np.array(vertices, dtype=float).reshape(-1, 3, 3)
+
+## Writes triangles to a binary STL file, as the nodes of a model are handed over.
+#
+#  Example usage:
+#  - w = StlWriter(f, segments=48)
+#  - w.begin()
+#  - store = SegmentStore(sink=w.write)
+#  - ... draw into the store ...
+#  - store.flush()
+#  - w.end()
+class StlWriter(object):
+
+	## Constructor.
+	#  @param f binary file object to write to. It must be seekable.
+	#  @param segments number of fragments of the cylinders and spheres ($fn).
+	#  @param transform 4x4 matrix applied to every node written by write, or None.
+	#  @param lod LevelOfDetail choosing the number of fragments of each node, or None to use segments everywhere.
+	def __init__(self, f, segments=48, transform=None, lod=None):
+		self.f = f
+		self.segments = segments
+		self.lod = lod
+		self.transform = None if transform is None else np.asarray(transform, dtype=float)
+		## Number of triangles written.
+		self.count = 0
+		## Tessellated unit shapes, keyed by (shape, fn).
+		self.prototypes = {}
+
+	## Return the tessellation of a unit shape: "cylinder", "sphere" or "flower".
+	def prototype(self, shape, fn):
+		key = (shape, fn)
+		if key not in self.prototypes:
+			if shape == "cylinder":
+				self.prototypes[key] = cylinderTriangles(fn)
+			elif shape == "sphere":
+				self.prototypes[key] = sphereTriangles(fn)
+			else:
+				# The flower spheres are scaled by the radius, but their offsets are not.
+				sphere = sphereTriangles(fn)
+				offsets = np.concatenate([np.tile(np.array(o, dtype=float), (len(sphere), 3, 1)) for o in FLOWER_OFFSETS])
+				self.prototypes[key] = (np.concatenate([sphere] * len(FLOWER_OFFSETS)), offsets)
+		return self.prototypes[key]
+
+	## Write the header. The number of triangles is filled in by end.
+	def begin(self):
+		self.f.write(b"binary STL written by Procedural-Trees".ljust(80, b" "))
+		self.start = self.f.tell()
+		self.f.write(struct.pack("<I", 0))
+
+	## Write the number of triangles in the header.
+	def end(self):
+		position = self.f.tell()
+		self.f.seek(self.start)
+		self.f.write(struct.pack("<I", self.count))
+		self.f.seek(position)
+
+	## Write triangles given in world coordinates.
+	#  @param triangles (T,3,3) array.
+	def writeTriangles(self, triangles):
+		if len(triangles) == 0:
+			return
+		records = np.zeros(len(triangles), dtype=STL_TRIANGLE)
+		normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+		length = np.linalg.norm(normals, axis=1)
+		length[length == 0] = 1
+		records["normal"] = normals / length[:, None]
+		records["vertices"] = triangles
+		self.f.write(records.tobytes())
+		self.count += len(triangles)
+
+	## Write instances of a tessellated unit shape.
+	#  @param template (T,3,3) triangles of the unit shape.
+	#  @param offset (T,3,3) offsets added after scaling, or None.
+	#  @param scales (K,3) scale of each instance along x, y and z.
+	#  @param transforms (K,4,4) transform of each instance.
+	def writeInstances(self, template, offset, scales, transforms):
+		if self.transform is not None:
+			transforms = np.matmul(self.transform, transforms)
+		step = max(1, CHUNK_TRIANGLES // max(1, len(template)))
+		for i in range(0, len(transforms), step):
+			s = scales[i:i + step]
+			m = transforms[i:i + step]
+			local = template[None] * s[:, None, None, :]
+			if offset is not None:
+				local = local + offset[None]
+			world = np.einsum("kij,ktvj->ktvi", m[:, :3, :3], local) + m[:, None, None, :3, 3]
+			self.writeTriangles(world.reshape(-1, 3, 3))
+
+	## Write the nodes of a store.
+	#  @param store a SegmentStore.
+	#  @param fn number of fragments, or None to use the level of detail or the writer default.
+	def write(self, store, fn=None):
+		if fn is None and self.lod is not None:
+			fragments = self.lod.fragments(store.radii())
+			for value in np.unique(fragments):
+				self.writeRows(store, fragments == value, value)
+			return
+		self.writeRows(store, np.ones(len(store), dtype=bool), self.segments if fn is None else fn)
+
+	## Write the selected nodes of a store with the same number of fragments.
+	#  @param store a SegmentStore.
+	#  @param selected boolean mask of the rows to write.
+	#  @param fn number of fragments.
+	def writeRows(self, store, selected, fn):
+		transforms = store.transforms()
+		radii = store.radii()
+		leaves = store.leaves() & selected
+		cylinders = ~store.leaves() & selected
+		spheres = cylinders & store.rounded()
+
+		r = radii[cylinders]
+		self.writeInstances(self.prototype("cylinder", fn), None,
+							np.stack((r, r, store.lengths()[cylinders]), axis=1), transforms[cylinders])
+		r = radii[spheres]
+		self.writeInstances(self.prototype("sphere", fn), None, np.stack((r, r, r), axis=1), transforms[spheres])
+		r = radii[leaves]
+		template, offset = self.prototype("flower", fn)
+		self.writeInstances(template, offset, np.stack((r, r, r), axis=1), transforms[leaves])
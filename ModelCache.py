@@ -0,0 +1,196 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# An on-disk cache of the generated model files.
+#
+# A model is addressed by the sha256 of everything its file depends on: the fields of the LSysObj,
+# the BuildTree options and the version of the exporters. Building the same model again returns the
+# cached file instead of deriving, interpreting and exporting it. The least recently used files are
+# removed when the cache grows over its size limit.
+#
+# To inspect the cache from the command line:
+# - python ModelCache.py stats [--dir DIR]
+# - python ModelCache.py clear [--dir DIR]
+#
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+
+## Version of the exported files. Change it whenever an exporter writes different files for the same model.
+EXPORTER_VERSION = 1
+
+## Default cache directory.
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "procedural-trees")
+
+## Default size limit of the cache, in bytes.
+DEFAULT_MAX_BYTES = 512 << 20
+
+## Name of the file keeping the hit and miss counters.
+STATS_FILE = "stats.json"
+
+## Caches model files by the hash of the rule and options that produced them.
+#
+#  Example usage:
+#  - cache = ModelCache()
+#  - key = cache.key(rule, options)
+#  - path = cache.get(key, ".scad")  -> the cached file, or None
+#  - cache.put(key, "lSystemModel1.scad", {"state": ...})
+class ModelCache(object):
+
+	## Constructor.
+	#  @param directory directory of the cached files, created if needed.
+	#  @param maxBytes size limit of the cache.
+	def __init__(self, directory=DEFAULT_DIRECTORY, maxBytes=DEFAULT_MAX_BYTES):
+		self.directory = directory
+		self.maxBytes = maxBytes
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	## Return the key of a model.
+	#  @param rule an LSysObj.
+	#  @param options dictionary of the options the model depends on, with json serializable values.
+	def key(self, rule, options):
+		content = {"rule": {"angle": rule.angle, "sentence": rule.sentence, "iterations": rule.iterations,
+							"color": rule.color, "rules": rule.rules, "rulesStochastic": rule.rulesStochastic},
+				   "options": options,
+				   "version": EXPORTER_VERSION}
+		return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+	## Return the path of the cached file of a key.
+	def path(self, key, extension):
+		return os.path.join(self.directory, key + extension)
+
+	## Return the path of the metadata of a key.
+	def metadataPath(self, key):
+		return os.path.join(self.directory, key + ".json")
+
+	## Return the cached file of a key, or None if it is not cached.
+	#  @param key a key returned by key.
+	#  @param extension extension of the file, e.g. ".scad".
+	def get(self, key, extension):
+		path = self.path(key, extension)
+		if not os.path.exists(path):
+			self.count("misses")
+			return None
+		# The modification time orders the files for the eviction.
+		os.utime(path, None)
+		self.count("hits")
+		return path
+
+	## Return the metadata stored with a key, or an empty dictionary.
+	def metadata(self, key):
+		try:
+			with open(self.metadataPath(key)) as f:
+				return json.load(f)
+		except (IOError, ValueError):
+			return {}
+
+	## Copy a file into the cache and evict the oldest files over the size limit.
+	#  @param key a key returned by key.
+	#  @param filepath path of the file to cache. Its extension is kept.
+	#  @param metadata json serializable dictionary stored with the file, or None.
+	#  @return the path of the cached file.
+	def put(self, key, filepath, metadata=None):
+		path = self.path(key, os.path.splitext(filepath)[1])
+		self.replace(filepath, path, shutil.copyfile)
+		if metadata is not None:
+			self.replace(metadata, self.metadataPath(key), self.dump)
+		self.evict()
+		return path
+
+	## Write a dictionary to a json file.
+	def dump(self, data, path):
+		with open(path, "w") as f:
+			json.dump(data, f)
+
+	## Write a file through a temporary file, so that other processes never see it half written.
+	#  @param source what write is given.
+	#  @param path path of the file.
+	#  @param write function called with the source and the temporary path.
+	def replace(self, source, path, write):
+		temporary = "%s.%d.tmp" % (path, os.getpid())
+		write(source, temporary)
+		os.replace(temporary, path)
+
+	## Return (modification time, size, path) of every cached model file.
+	def entries(self):
+		entries = []
+		for name in os.listdir(self.directory):
+			if name == STATS_FILE or name.endswith(".json") or name.endswith(".tmp"):
+				continue
+			path = os.path.join(self.directory, name)
+			try:
+				st = os.stat(path)
+			except OSError:
+				continue
+			entries.append((st.st_mtime, st.st_size, path))
+		return entries
+
+	## Remove the least recently used files until the cache fits in maxBytes.
+	#  @return the number of files removed.
+	def evict(self):
+		entries = sorted(self.entries())
+		total = sum(size for mtime, size, path in entries)
+		removed = 0
+		for mtime, size, path in entries:
+			if total <= self.maxBytes:
+				break
+			key = os.path.splitext(os.path.basename(path))[0]
+			for p in (path, self.metadataPath(key)):
+				if os.path.exists(p):
+					os.remove(p)
+			total -= size
+			removed += 1
+		return removed
+
+	## Increment a persistent counter.
+	def count(self, name):
+		stats = self.counters()
+		stats[name] = stats.get(name, 0) + 1
+		self.replace(stats, os.path.join(self.directory, STATS_FILE), self.dump)
+
+	## Return the persistent counters.
+	def counters(self):
+		try:
+			with open(os.path.join(self.directory, STATS_FILE)) as f:
+				return json.load(f)
+		except (IOError, ValueError):
+			return {}
+
+	## Return the number of files, their size, the size limit and the hit and miss counters.
+	def stats(self):
+		entries = self.entries()
+		counters = self.counters()
+		return {"entries": len(entries), "bytes": sum(size for mtime, size, path in entries),
+				"maxBytes": self.maxBytes, "hits": counters.get("hits", 0), "misses": counters.get("misses", 0)}
+
+	## Remove every cached file and reset the counters.
+	def clear(self):
+		for name in os.listdir(self.directory):
+			os.remove(os.path.join(self.directory, name))
+
+## Main program to inspect the cache.
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Inspect the cache of generated models.")
+	parser.add_argument("command", choices=["stats", "clear"])
+	parser.add_argument("--dir", default=DEFAULT_DIRECTORY, help="cache directory")
+	args = parser.parse_args(argv)
+
+	cache = ModelCache(args.dir)
+	if args.command == "clear":
+		cache.clear()
+	stats = cache.stats()
+	lookups = stats["hits"] + stats["misses"]
+	print("%s: %d files, %d of %d bytes, %d hits, %d misses (%.1f%% hit rate)" %
+		  (cache.directory, stats["entries"], stats["bytes"], stats["maxBytes"], stats["hits"], stats["misses"],
+		   100.0 * stats["hits"] / lookups if lookups else 0))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
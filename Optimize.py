@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# Optimization passes over the nodes of a SegmentStore.
+#
+# Rules such as 'F' -> "FF" draw every branch as a run of identical cylinders, one after the other.
+# Fusing each run into a single longer cylinder gives the same shape with far fewer primitives,
+# which shrinks the scad files and the time OpenSCAD takes to render them.
+#
+
+import numpy as np
+
+## Tolerance used to compare positions and rotations.
+TOLERANCE = 1e-6
+
+## Fuse consecutive collinear cylinders with the same radius, color and spheres into a single cylinder.
+#  A cylinder is fused with the previous row when it starts where the previous one ends, in the same direction.
+#  Rounded cylinders are only fused when both are at least as long as their radius, so that the sphere
+#  dropped at the joint lies inside the fused cylinder.
+#  @param store a SegmentStore, changed in place.
+#  @return the number of rows eliminated.
+def mergeCollinear(store):
+	n = len(store)
+	if n < 2:
+		return 0
+	transforms = store.transforms()
+	radii = store.radii()
+	lengths = store.lengths()
+	colors = store.colors()
+	rounded = store.rounded()
+	leaves = store.leaves()
+
+	# Cylinders are drawn along the z axis of their transform.
+	starts = transforms[:, :3, 3]
+	ends = starts + transforms[:, :3, 2] * lengths[:, None]
+
+	fused = np.zeros(n, dtype=bool)
+	fused[1:] = (~leaves[1:] & ~leaves[:-1] &
+				 (radii[1:] == radii[:-1]) &
+				 (colors[1:] == colors[:-1]) &
+				 (rounded[1:] == rounded[:-1]) &
+				 np.all(np.abs(transforms[1:, :3, :3] - transforms[:-1, :3, :3]) < TOLERANCE, axis=(1, 2)) &
+				 np.all(np.abs(starts[1:] - ends[:-1]) < TOLERANCE, axis=1))
+	fused[1:] &= ~rounded[1:] | ((lengths[1:] >= radii[1:]) & (lengths[:-1] >= radii[:-1]))
+
+	heads = np.nonzero(~fused)[0]
+	eliminated = n - len(heads)
+	if eliminated == 0:
+		return 0
+	runLengths = np.add.reduceat(lengths, heads)
+	store.compact(heads)
+	store.lengths()[:] = runLengths
+	return eliminated
+
+## A store sink that fuses collinear cylinders before handing the rows over to another sink.
+#
+#  Example usage:
+#  - merger = CollinearMerger(writer.write)
+#  - store = SegmentStore(sink=merger)
+#  - ... draw into the store ...
+#  - store.flush()
+#  - merger.eliminated  -> number of rows eliminated
+class CollinearMerger(object):
+
+	## Constructor.
+	#  @param sink function called with the store after the merge, or None.
+	def __init__(self, sink=None):
+		self.sink = sink
+		## Number of rows eliminated so far.
+		self.eliminated = 0
+
+	## Fuse the rows of a store and hand them over to the sink.
+	def __call__(self, store):
+		self.eliminated += mergeCollinear(store)
+		if self.sink is not None:
+			self.sink(store)
@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# Renders a model with several OpenSCAD processes at once.
+#
+# OpenSCAD renders the union of a whole tree on a single core. The nodes are split into spatial parts
+# of about the same size, each part is written to its own scad file and rendered to stl by a separate
+# OpenSCAD process, with at most one process per core, and the parts are concatenated into one stl file.
+# As with the stl exporter, the parts are not merged with a boolean union: the shells of neighbouring
+# parts may overlap where a branch crosses a split plane.
+#
+
+from __future__ import division
+
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from Mesh import StlWriter, readStl
+
+## Splits the nodes of a model into parts and renders them with concurrent OpenSCAD processes.
+#
+#  Example usage:
+#  - renderer = ParallelRenderer(parts=8)
+#  - for i, index in enumerate(renderer.partition(store)): ... write store.take(index) to part<i>.scad ...
+#  - renderer.render(["part0.scad", ...], "tree.stl")
+class ParallelRenderer(object):
+
+	## Constructor.
+	#  @param parts number of spatial parts, or None for one per worker.
+	#  @param workers maximum number of concurrent OpenSCAD processes, or None for one per core.
+	#  @param openscad OpenSCAD executable.
+	#  @param progress a Progress.Progress told about the parts rendered, or None.
+	def __init__(self, parts=None, workers=None, openscad="openscad", progress=None):
+		self.workers = workers or os.cpu_count() or 1
+		self.parts = parts or self.workers
+		self.openscad = openscad
+		self.progress = progress
+
+	## Split the nodes of a store into parts of about the same number of nodes.
+	#  The nodes are split recursively at the median of their centers, across the widest extent of each part.
+	#  @param store a SegmentStore.
+	#  @return list of arrays of row indices, without empty parts.
+	def partition(self, store):
+		transforms = store.transforms()
+		# Cylinders are drawn along the z axis of their transform.
+		centers = transforms[:, :3, 3] + transforms[:, :3, 2] * (store.lengths()[:, None] / 2)
+		return [index for index in self.split(centers, np.arange(len(store)), self.parts) if len(index) > 0]
+
+	## Split the given rows into the given number of parts.
+	def split(self, centers, index, parts):
+		if parts <= 1 or len(index) <= 1:
+			return [index]
+		points = centers[index]
+		axis = np.argmax(points.max(axis=0) - points.min(axis=0))
+		left = parts // 2
+		k = len(index) * left // parts
+		order = np.argpartition(points[:, axis], k)
+		return self.split(centers, index[order[:k]], left) + self.split(centers, index[order[k:]], parts - left)
+
+	## Render scad files to stl files, with at most workers processes at once.
+	#  @param scadPaths paths of the scad files.
+	#  @return the paths of the stl files, in the same order.
+	def renderParts(self, scadPaths):
+		stlPaths = [os.path.splitext(path)[0] + ".stl" for path in scadPaths]
+		processes = []
+		stopped = []
+		# Guards stopped and processes, so that no process starts after the others were killed.
+		lock = threading.Lock()
+
+		def render(i):
+			with lock:
+				if stopped:
+					return
+				process = subprocess.Popen([self.openscad, "-o", stlPaths[i], scadPaths[i]],
+										   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+				processes.append(process)
+			output = process.communicate()[0]
+			# A process killed by the loop below is not a failure of OpenSCAD.
+			if process.returncode != 0 and not stopped:
+				raise RuntimeError("OpenSCAD failed to render %s:\n%s" % (scadPaths[i], output.decode("utf-8", "replace")))
+
+		with ThreadPoolExecutor(max_workers=self.workers) as pool:
+			futures = [pool.submit(render, i) for i in range(len(scadPaths))]
+			try:
+				for done, future in enumerate(futures, 1):
+					future.result()
+					if self.progress is not None:
+						self.progress.report("parts", done)
+			except BaseException:
+				for future in futures:
+					future.cancel()
+				with lock:
+					stopped.append(True)
+					for process in processes:
+						if process.poll() is None:
+							process.kill()
+				raise
+		return stlPaths
+
+	## Concatenate stl files into a single binary stl file.
+	#  @param stlPaths paths of the stl files, binary or ascii.
+	#  @param filepath path of the written file.
+	def merge(self, stlPaths, filepath):
+		with open(filepath, "wb") as f:
+			writer = StlWriter(f)
+			writer.begin()
+			for path in stlPaths:
+				writer.writeTriangles(readStl(path))
+			writer.end()
+
+	## Render scad files in parallel and merge the results into a single stl file.
+	#  @param scadPaths paths of the scad files of the parts.
+	#  @param filepath path of the written stl file.
+	def render(self, scadPaths, filepath):
+		self.merge(self.renderParts(scadPaths), filepath)
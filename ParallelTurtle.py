@@ -0,0 +1,111 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# A BatchTurtle that interprets the top-level branches of a program in a pool of processes.
+#
+# Once the state of the turtle at a top-level '[' is known, the branch up to the matching ']' does not
+# depend on anything else, since the pop restores that state. The program is split into its trunk, i.e.
+# the opcodes outside the top-level branches, and the branches. The trunk is interpreted first to find
+# the state each branch starts from, then the branches are interpreted by worker processes and their
+# nodes are merged back in program order. The node colors depend on the whole program and are still
+# computed by the BatchTurtle.
+#
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from BatchTurtle import BatchTurtle
+from Brackets import BracketIndex
+
+## Return the nodes of branches of a program, each drawn from its own starting state. Runs in a worker process.
+#  @param branches - list of (ops, args, m, r) tuples: the opcodes inside a branch, the transform and the radius at its start
+#  @param d - length of each step
+#  @return a list of (nodes, transforms, radii, leaves) tuples, see BatchTurtle.nodeTransforms
+def branchNodes(branches, d):
+	result = []
+	for ops, args, m, r in branches:
+		nodes, transforms, radii, leaves = BatchTurtle(r=r).nodeTransforms(ops, args, d)
+		result.append((nodes, np.matmul(m, transforms), radii, leaves))
+	return result
+
+## Interprets a compiled program, spreading its top-level branches over a pool of processes.
+#  The nodes are the same as the ones of a BatchTurtle.
+#
+#  Example usage:
+#  - t = ParallelTurtle(workers=4)
+#  - t.run(compileSentence(sentence, angle), 4)
+#  - t.store.transforms()  -> (N,4,4) array with the transform of each node
+class ParallelTurtle(BatchTurtle):
+
+	## Smallest number of opcodes interpreted in parallel. Smaller programs are interpreted in this process.
+	MIN_OPS = 100000
+
+	## Number of tasks per worker, so that branches of different sizes keep every worker busy.
+	TASKS_PER_WORKER = 4
+
+	## Constructor.
+	#  @param workers number of processes, or None to use every core.
+	#  @see BatchTurtle
+	def __init__(self, r=2, col=None, rounded=False, store=None, rng=None, workers=None):
+		BatchTurtle.__init__(self, r, col, rounded, store, rng)
+		self.workers = workers or os.cpu_count() or 1
+
+	## Return the (push, pop) indices of the top-level branches of a program.
+	#  Pushes that are never popped are not branches: what follows them is part of the trunk.
+	#  @param ops - opcode array
+	def branches(self, ops):
+		return BracketIndex(ops).branches(1)
+
+	## Group the branches into tasks with about the same number of opcodes.
+	#  @param pushes - indices of the branch pushes
+	#  @param pops - indices of the branch pops
+	#  @return a list of index arrays into pushes
+	def tasks(self, pushes, pops):
+		sizes = np.cumsum(pops - pushes)
+		count = min(len(pushes), self.workers * self.TASKS_PER_WORKER)
+		bounds = np.searchsorted(sizes, sizes[-1] * np.arange(1, count) / count)
+		return [task for task in np.split(np.arange(len(pushes)), np.unique(bounds)) if len(task) > 0]
+
+	## Return the nodes of a program with their transforms and radii.
+	#  @see BatchTurtle.nodeTransforms
+	def nodeTransforms(self, ops, args, d):
+		if len(ops) < self.MIN_OPS or self.workers < 2:
+			return BatchTurtle.nodeTransforms(self, ops, args, d)
+		pushes, pops = self.branches(ops)
+		if len(pushes) < 2:
+			return BatchTurtle.nodeTransforms(self, ops, args, d)
+
+		# Mark the opcodes of the branches, brackets included.
+		marks = np.zeros(len(ops) + 1, dtype=np.int64)
+		marks[pushes] += 1
+		marks[pops + 1] -= 1
+		trunk = np.nonzero(np.cumsum(marks[:-1]) == 0)[0]
+
+		# Interpret the trunk: the state before each branch is the state after the trunk opcode before its push.
+		acc, radii, parent = self.states(ops[trunk], args[trunk], d)
+		before = np.searchsorted(trunk, pushes) - 1
+		starts = np.empty((len(pushes), 4, 4))
+		starts[:] = np.identity(4)
+		starts[before >= 0] = acc[before[before >= 0]]
+		startRadii = np.where(before >= 0, radii[np.maximum(before, 0)], self.r)
+
+		parts = []
+		nodes, transforms, nodeRadii, leaves = self.place(ops[trunk], acc, radii, parent)
+		parts.append((trunk[nodes], transforms, nodeRadii, leaves))
+
+		with ProcessPoolExecutor(max_workers=self.workers) as pool:
+			futures = []
+			for task in self.tasks(pushes, pops):
+				branches = [(ops[pushes[i] + 1:pops[i]], args[pushes[i] + 1:pops[i]], starts[i], startRadii[i]) for i in task]
+				futures.append((task, pool.submit(branchNodes, branches, d)))
+			for task, future in futures:
+				for i, (nodes, transforms, nodeRadii, leaves) in zip(task, future.result()):
+					parts.append((nodes + pushes[i] + 1, transforms, nodeRadii, leaves))
+
+		nodes, transforms, nodeRadii, leaves = [np.concatenate(column) for column in zip(*parts)]
+		order = np.argsort(nodes, kind="stable")
+		return nodes[order], transforms[order], nodeRadii[order], leaves[order]
@@ -0,0 +1,153 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# Builds the L-System models in stages that keep their last result.
+#
+# A model goes through four stages: derive the sentence, compile it into opcodes, interpret the opcodes
+# into a SegmentStore and export the store. The key of each stage holds the key of the stage before it
+# and the parameters the stage itself reads, so a stage runs again only when something it depends on
+# changed: a new angle compiles and interprets the kept sentence again, a new axis only exports the
+# kept store again.
+#
+
+import os
+import json
+
+from Optimize import mergeCollinear
+
+## Length of a step of the L-System turtles.
+STEP = 4
+
+## A step of the pipeline, keeping the key and the value of its last run.
+#
+#  Example usage:
+#  - stage = Stage("derive", derive)
+#  - stage.get(key, rule)  -> runs derive(rule)
+#  - stage.get(key, rule)  -> returns the same value without running derive
+class Stage(object):
+
+	## Constructor.
+	#  @param name name of the stage, printed by Pipeline.report.
+	#  @param compute function computing the value of the stage from the arguments of get.
+	def __init__(self, name, compute):
+		self.name = name
+		self.compute = compute
+		self.key = None
+		self.value = None
+		## Number of times the stage ran.
+		self.runs = 0
+		## Number of times the value of the stage was reused.
+		self.reuses = 0
+		## Whether the last get ran the stage.
+		self.ran = False
+
+	## Return the value of the stage for a key, running the stage only if the key changed.
+	#  @param key any value comparable with ==.
+	#  @param args arguments of compute.
+	def get(self, key, *args):
+		if self.value is not None and key == self.key:
+			self.reuses += 1
+			self.ran = False
+			return self.value
+		# Release the old value before computing the new one.
+		self.invalidate()
+		self.value = self.compute(*args)
+		self.key = key
+		self.runs += 1
+		self.ran = True
+		return self.value
+
+	## Forget the value of the stage, so that the next get runs it.
+	def invalidate(self):
+		self.key = None
+		self.value = None
+
+## The stages of the L-System models of a BuildTree.
+#
+#  Stochastic sentences are kept while only the angle or the export options change. Running the same
+#  model again, or seeding the random number generator in between, derives a new random tree.
+#
+#  Example usage:
+#  - pipeline = Pipeline(tree)
+#  - pipeline.run(rule, "lSystemModel1.scad")  -> runs every stage
+#  - rule.angle = 30
+#  - pipeline.run(rule, "lSystemModel2.scad")  -> compiles, interprets and exports the kept sentence
+class Pipeline(object):
+
+	## Constructor.
+	#  @param tree the BuildTree whose options the stages read.
+	def __init__(self, tree):
+		self.tree = tree
+		self.derive = Stage("derive", self.deriveSentence)
+		self.compile = Stage("compile", self.compileSentence)
+		self.interpret = Stage("interpret", self.interpretProgram)
+		self.export = Stage("export", self.exportStore)
+		self.stages = [self.derive, self.compile, self.interpret, self.export]
+		## State of the random number generator at the end of the last run.
+		self.state = None
+
+	## Return the path of the model of a rule, running only the stages whose dependencies changed.
+	#  @param rule an LSysObj.
+	#  @param filepath path of the file written if the export stage runs.
+	#  @return filepath, or the file of the last run if the model is the same.
+	def run(self, rule, filepath):
+		lSys = self.tree.lSys
+		deriveKey = (lSys.stochastic, rule.iterations, rule.sentence,
+					 json.dumps(rule.rules, sort_keys=True), json.dumps(rule.rulesStochastic, sort_keys=True))
+		compileKey = (deriveKey, rule.angle)
+		interpretKey = (compileKey, rule.color, STEP, lSys.spheres, lSys.batch, lSys.merge, lSys.pruneDepth)
+		exportKey = (interpretKey, self.tree.exportOptions())
+
+		if lSys.stochastic and (exportKey == self.export.key or lSys.getState() != self.state):
+			# The same model asked again, or a reseeded generator, draws a new random tree.
+			self.invalidate()
+		if self.export.value is not None and not os.path.exists(self.export.value):
+			self.export.invalidate()
+
+		sentence = self.derive.get(deriveKey, rule)
+		program = self.compile.get(compileKey, sentence, rule.angle)
+		store = self.interpret.get(interpretKey, program, rule.color)
+		if not isinstance(program, tuple):
+			# A program read from a spilled sentence is a generator, which cannot be run twice.
+			self.compile.invalidate()
+		path = self.export.get(exportKey, store, filepath)
+		self.state = lSys.getState()
+		self.report()
+		return path
+
+	## Derive the sentence of a rule.
+	def deriveSentence(self, rule):
+		return self.tree.lSys.derive(rule.iterations, rule.sentence, rule.rules, rule.rulesStochastic)
+
+	## Compile a sentence into opcodes.
+	def compileSentence(self, sentence, angle):
+		print("Angle: " + str(angle))
+		return self.tree.lSys.compile(sentence, angle)
+
+	## Interpret the opcodes into a SegmentStore, fusing the collinear cylinders when merging is on.
+	def interpretProgram(self, program, col):
+		lSys = self.tree.lSys
+		store = lSys.segments(col, program, STEP)
+		if lSys.merge:
+			print("Merged segments: " + str(mergeCollinear(store)))
+		return store
+
+	## Write the store with the current exporter and return the path of the file.
+	def exportStore(self, store, filepath):
+		self.tree.writeModel(lambda s: s.append(store), filepath, self.tree.lod)
+		return filepath
+
+	## Forget the value of every stage.
+	def invalidate(self):
+		for stage in self.stages:
+			stage.invalidate()
+
+	## Print which stages ran and which were reused.
+	def report(self):
+		print("Stages run: " + (", ".join(stage.name for stage in self.stages if stage.ran) or "none"))
+
+	## Return the number of runs and reuses of each stage.
+	def stats(self):
+		return dict((stage.name, {"runs": stage.runs, "reuses": stage.reuses}) for stage in self.stages)
@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# Progress reports and cancellation of the model builds.
+#
+# The stages of a build report what they have done so far to a Progress object: the generations derived,
+# the segments emitted and the bytes written. Every report is also a point where a build running on
+# another thread stops if it was cancelled.
+#
+
+## Raised by a Progress report when the build was cancelled.
+class BuildCancelled(Exception):
+	pass
+
+## Receives the progress reports of a build and cancels it on request.
+#
+#  Example usage:
+#  - progress = Progress(lambda name, value: print(name, value))
+#  - tree.setProgress(progress)
+#  - progress.cancel()  -> from another thread, the next report raises BuildCancelled
+class Progress(object):
+
+	## Number of opcodes interpreted between two reports of the turtles.
+	INTERVAL = 4096
+
+	## Constructor.
+	#  @param callback function called with the name and the value of each report, or None.
+	def __init__(self, callback=None):
+		self.callback = callback
+		self.cancelled = False
+		## Last value of each report.
+		self.values = {}
+
+	## Ask the build to stop at its next report.
+	def cancel(self):
+		self.cancelled = True
+
+	## Report a value and raise BuildCancelled if the build was cancelled.
+	#  @param name what is counted: "generations", "segments" or "bytes".
+	#  @param value count so far.
+	def report(self, name, value):
+		if self.cancelled:
+			raise BuildCancelled("Build cancelled")
+		self.values[name] = value
+		if self.callback is not None:
+			self.callback(name, value)
+
+## A store sink that reports the segments emitted and the bytes written before handing the rows over to another sink.
+class ProgressSink(object):
+
+	## Constructor.
+	#  @param progress a Progress.
+	#  @param sink function called with the store.
+	#  @param f file written by the sink, or None.
+	def __init__(self, progress, sink, f=None):
+		self.progress = progress
+		self.sink = sink
+		self.f = f
+
+	## Report the rows of a store and hand them over to the sink.
+	def __call__(self, store):
+		self.progress.report("segments", store.total())
+		self.sink(store)
+		if self.f is not None:
+			self.progress.report("bytes", self.f.tell())
@@ -30,14 +30,36 @@ from solid.utils import *
 
 class RecTree():
 
+	## Constructor.
+	#  @param seed seed of the random number generator, or None to seed it from the operating system.
+	def __init__(self, seed=None):
+		## Random number generator of the tree.
+		self.rng = np.random.RandomState(seed)
+
+	## Seeds the random number generator, so that the tree can be reproduced.
+	def seed(self, seed):
+		self.rng.seed(seed)
+
+	## Returns the state of the random number generator, which can be pickled.
+	def getState(self):
+		return self.rng.get_state()
+
+	## Restores a state returned by getState.
+	def setState(self, state):
+		self.rng.set_state(state)
+
 	## A Normal random variable generator that takes a range, like
 	# random.uniform, instead of mean and standard deviation.
 	def rn(self, aa, bb):
-		return np.random.normal((bb+aa)/2., (bb-aa)/4.)
+		return self.rng.normal((bb+aa)/2., (bb-aa)/4.)
 
-	ru = np.random.uniform
+	## Uniform random variable in [low, high).
+	def ru(self, low=0.0, high=1.0, size=None):
+		return self.rng.uniform(low, high, size)
 
-	ri = np.random.randint
+	## Random integer in [low, high).
+	def ri(self, low, high=None, size=None):
+		return self.rng.randint(low, high, size)
 
 	## Create a stem and leaf
 	def stemAndLeaf(self):
@@ -0,0 +1,229 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# Writes the nodes of a SegmentStore straight to a scad file.
+#
+# The SolidPython path builds the whole object tree and then the whole scad string before writing it.
+# The writer emits each node as soon as it is handed over, using compact number formatting,
+# so the memory used does not depend on the size of the model.
+#
+
+from solid.solidpython import OpenSCADObject
+
+## Number of decimal places written for the matrices and sizes.
+PRECISION = 4
+
+## Module drawing a flower: four spheres of radius r around the origin.
+#  Written once per file, so that every leaf is a single call instead of a union of four spheres.
+FLOWER_MODULE = ("module flower(r) {\n"
+				 "\ttranslate([0,0.5,0]) sphere(r=r);\n"
+				 "\ttranslate([0,-0.5,0]) sphere(r=r);\n"
+				 "\ttranslate([0,0,0.5]) sphere(r=r);\n"
+				 "\ttranslate([0,0,-0.5]) sphere(r=r);\n"
+				 "}\n")
+
+## Return a SolidPython call to the flower module. The file must include FLOWER_MODULE.
+#  @param r sphere radius.
+#  @param fn number of fragments of the spheres, or None to use $fn.
+def flowerInstance(r, fn=None):
+	params = {"r": r}
+	if fn is not None:
+		params["segments"] = fn
+	return OpenSCADObject("flower", params)
+
+## Return a number formatted with at most PRECISION decimal places and no trailing zeros.
+def fmt(x):
+	s = "%.*f" % (PRECISION, x)
+	if '.' in s:
+		s = s.rstrip('0').rstrip('.')
+	return "0" if s == "-0" else s
+
+## Return a vector formatted as an openscad list.
+def fmtList(v):
+	return "[" + ",".join([fmt(x) for x in v]) + "]"
+
+## Return the first three rows of a 4x4 transform formatted as an openscad matrix.
+#  The fourth row of a multmatrix is always [0,0,0,1] and may be omitted.
+def fmtMatrix(m):
+	return "[" + ",".join([fmtList(row) for row in m[:3]]) + "]"
+
+## Streams a model to a scad file.
+#
+#  Example usage:
+#  - w = ScadWriter(f, segments=48)
+#  - w.begin()
+#  - store = SegmentStore(sink=w.write)
+#  - ... draw into the store ...
+#  - store.flush()
+#  - w.end()
+class ScadWriter(object):
+
+	## Constructor.
+	#  @param f file object to write to.
+	#  @param segments value of $fn, or None to leave it unset.
+	#  @param lod LevelOfDetail choosing the $fn of each node, or None to use segments everywhere.
+	def __init__(self, f, segments=None, lod=None):
+		self.f = f
+		self.segments = segments
+		self.lod = lod
+		## Number of blocks opened and not closed yet.
+		self.depth = 0
+		## Number of nodes written.
+		self.count = 0
+
+	## Write the header and the flower module, and open the top level union.
+	def begin(self):
+		if self.segments is not None:
+			self.f.write("$fn = %d;\n\n" % self.segments)
+		self.f.write(FLOWER_MODULE + "\n")
+		self.open("union()")
+
+	## Open a block, e.g. open("rotate(a=90, v=[0,1,0])").
+	def open(self, statement):
+		self.f.write(statement + " {\n")
+		self.depth += 1
+
+	## Close the last opened block.
+	def close(self):
+		self.depth -= 1
+		self.f.write("}\n")
+
+	## Write raw scad code.
+	def raw(self, text):
+		self.f.write(text)
+		if not text.endswith("\n"):
+			self.f.write("\n")
+
+	## Close every opened block.
+	def end(self):
+		while self.depth > 0:
+			self.close()
+
+	## Return the $fn argument of every row of a store, e.g. ", $fn=12", or empty strings without a level of detail.
+	def fragments(self, store):
+		if self.lod is None:
+			return [""] * len(store)
+		return [", $fn=%d" % fn for fn in self.lod.fragments(store.radii())]
+
+	## Write the rows of a store.
+	#  @param store a SegmentStore.
+	def write(self, store):
+		## Formatted colors indexed by the color indices of the store.
+		self.palette = [fmtList(c) for c in store.palette]
+		lines = []
+		for m, r, h, c, rd, leaf, fn in zip(store.transforms(), store.radii(), store.lengths(), store.colors(),
+											store.rounded(), store.leaves(), self.fragments(store)):
+			lines.append(self.node(fmtMatrix(m), fmt(r), fmt(h), c, rd, leaf, fn))
+		self.f.write("".join(lines))
+		self.count += len(lines)
+
+	## Return the scad code of a single node.
+	#  @param m formatted transform.
+	#  @param r formatted radius.
+	#  @param h formatted height.
+	#  @param c color index.
+	#  @param rd whether to add a sphere to the cylinder.
+	#  @param leaf whether the node is a flower.
+	#  @param fn formatted $fn argument, see fragments.
+	def node(self, m, r, h, c, rd, leaf, fn=""):
+		c = self.palette[c]
+		if leaf:
+			return "multmatrix(%s) color(%s) flower(%s%s);\n" % (m, c, r, fn)
+		if rd:
+			return "color(%s) multmatrix(%s) {sphere(r=%s%s); cylinder(r=%s, h=%s%s);}\n" % (c, m, r, fn, r, h, fn)
+		return "color(%s) multmatrix(%s) cylinder(r=%s, h=%s%s);\n" % (c, m, r, h, fn)
+
+## Streams a model to a scad file as a data table iterated by a for loop.
+#
+#  Each node is written as a row [m, r, h, c, s, l] of the segments array, where c is an index in the
+#  palette array, s tells whether to add a sphere and l whether the node is a flower.
+#  The segment and flower modules are written once and called for each row, which is much smaller
+#  and faster to parse than a fully spelled-out block per node.
+#
+#  The rows are written as they are handed over. The blocks opened around them and the raw code are kept
+#  and written after the table, with the for loop in place of the rows.
+class ScadTableWriter(ScadWriter):
+
+	## Modules called for each row of the table.
+	MODULES = ("module segment(m, r, h, c, s) {\n"
+			   "\tcolor(c) multmatrix(m) {\n"
+			   "\t\tif (s) sphere(r=r);\n"
+			   "\t\tcylinder(r=r, h=h);\n"
+			   "\t}\n"
+			   "}\n\n" + FLOWER_MODULE + "\n")
+
+	## Loop drawing every row of the table.
+	LOOP = ("for (p = segments) if (p[5]) multmatrix(p[0]) color(palette[p[3]]) flower(p[1]); "
+			"else segment(p[0], p[1], p[2], palette[p[3]], p[4]);\n")
+
+	## Loop drawing every row of the table, when the rows end with their $fn.
+	LOD_LOOP = ("for (p = segments) if (p[5]) multmatrix(p[0]) color(palette[p[3]]) flower(p[1], $fn=p[6]); "
+				"else segment(p[0], p[1], p[2], palette[p[3]], p[4], $fn=p[6]);\n")
+
+	## Constructor.
+	#  @param f file object to write to.
+	#  @param segments value of $fn, or None to leave it unset.
+	#  @param lod LevelOfDetail choosing the $fn of each row, or None to use segments everywhere.
+	def __init__(self, f, segments=None, lod=None):
+		ScadWriter.__init__(self, f, segments, lod)
+		## Code written after the table.
+		self.body = []
+		self.palette = []
+
+	## Write the header, the modules, and start the table.
+	def begin(self):
+		if self.segments is not None:
+			self.f.write("$fn = %d;\n\n" % self.segments)
+		self.f.write(self.MODULES)
+		self.f.write("segments = [\n")
+		self.open("union()")
+
+	## Open a block, e.g. open("rotate(a=90, v=[0,1,0])").
+	def open(self, statement):
+		self.body.append(statement + " {\n")
+		self.depth += 1
+
+	## Close the last opened block.
+	def close(self):
+		self.depth -= 1
+		self.body.append("}\n")
+
+	## Write raw scad code after the table.
+	def raw(self, text):
+		self.body.append(text if text.endswith("\n") else text + "\n")
+
+	## Close the table and every opened block and write the code kept so far.
+	def end(self):
+		ScadWriter.end(self)
+		self.f.write("\n];\n\n")
+		self.f.write("palette = [%s];\n\n" % ",".join(self.palette))
+		self.f.write("".join(self.body))
+
+	## Write the rows of a store.
+	#  @param store a SegmentStore.
+	def write(self, store):
+		if len(store) == 0:
+			return
+		if self.count == 0:
+			self.body.append(self.LOOP if self.lod is None else self.LOD_LOOP)
+		else:
+			self.f.write(",\n")
+		self.palette = [fmtList(c) for c in store.palette]
+		rows = []
+		for m, r, h, c, rd, leaf, fn in zip(store.transforms(), store.radii(), store.lengths(), store.colors(),
+											store.rounded(), store.leaves(), self.fragments(store)):
+			rows.append(self.node(fmtMatrix(m), fmt(r), fmt(h), c, rd, leaf, fn))
+		self.f.write(",\n".join(rows))
+		self.count += len(rows)
+
+	## Return the $fn column of every row of a store, e.g. ",12", or empty strings without a level of detail.
+	def fragments(self, store):
+		if self.lod is None:
+			return [""] * len(store)
+		return ["," + str(fn) for fn in self.lod.fragments(store.radii())]
+
+	## Return the table row of a single node.
+	def node(self, m, r, h, c, rd, leaf, fn=""):
+		return "[%s,%s,%s,%d,%s,%s%s]" % (m, r, h, c, "true" if rd else "false", "true" if leaf else "false", fn)
@@ -0,0 +1,223 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+## @package Tree
+#
+# A compact, array-backed store for the nodes drawn by the turtles.
+#
+# Instead of a SolidPython object graph per cylinder, the store keeps one row per node in a set of
+# NumPy arrays (structure of arrays): transform, radius, length, color index, rounded flag and leaf flag.
+# The SolidPython objects are only created when the model is exported.
+# A store with a sink hands its rows over whenever it is full and starts over, so a model can be
+# written while it is drawn using a fixed amount of memory.
+#
+
+import numpy as np
+
+# Assumes SolidPython is in site-packages or elsewhere in sys.path
+from solid import *
+from solid.utils import *
+
+from ScadWriter import flowerInstance
+
+## Stores the cylinders and flowers of a model.
+#
+#  Example usage:
+#  - s = SegmentStore()
+#  - s.add(m, 2, 4, (0.6, 0.4, 0.12), False)
+#  - s.toSolid()  -> a union with one node per row
+class SegmentStore(object):
+
+	## Constructor.
+	#  @param capacity initial number of rows.
+	#  @param sink function called with the store when it is full, e.g. ScadWriter.write, or None to grow the store.
+	def __init__(self, capacity=1024, sink=None):
+		## Colors indexed by the color index of each row.
+		self.palette = []
+		self.paletteIndex = {}
+		self.sink = sink
+		## Number of rows handed over to the sink.
+		self.flushed = 0
+		self.allocate(max(capacity, 1))
+
+	## Allocate empty arrays with the given number of rows.
+	def allocate(self, capacity):
+		## Number of rows in use.
+		self.count = 0
+		## (N,4,4) transform of each node.
+		self.transformArray = np.empty((capacity, 4, 4))
+		## Cylinder radius, or sphere radius of the flowers.
+		self.radiusArray = np.empty(capacity)
+		## Cylinder height.
+		self.lengthArray = np.empty(capacity)
+		## Index of the node color in the palette.
+		self.colorArray = np.empty(capacity, dtype=np.int32)
+		## Whether a sphere is added to the cylinder.
+		self.roundedArray = np.empty(capacity, dtype=bool)
+		## Whether the node is a flower.
+		self.leafArray = np.empty(capacity, dtype=bool)
+
+	## Remove every row, keeping the palette.
+	def clear(self):
+		self.count = 0
+
+	## Return the number of rows.
+	def __len__(self):
+		return self.count
+
+	## Return the number of rows added since the store was created, including the flushed ones.
+	def total(self):
+		return self.flushed + self.count
+
+	## Hand the rows over to the sink and remove them.
+	def flush(self):
+		if self.sink is not None and self.count > 0:
+			self.sink(self)
+			self.flushed += self.count
+			self.count = 0
+
+	## Return the index of a color in the palette, adding it if needed.
+	#  @param c a color name or an rgb sequence.
+	def colorIndex(self, c):
+		c = tuple(c)
+		i = self.paletteIndex.get(c)
+		if i is None:
+			i = len(self.palette)
+			self.palette.append(c)
+			self.paletteIndex[c] = i
+		return i
+
+	## Make room for n more rows.
+	def reserve(self, n):
+		needed = self.count + n
+		capacity = len(self.radiusArray)
+		if needed <= capacity:
+			return
+		while capacity < needed:
+			capacity *= 2
+		for name in ("transformArray", "radiusArray", "lengthArray", "colorArray", "roundedArray", "leafArray"):
+			old = getattr(self, name)
+			new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+			new[:self.count] = old[:self.count]
+			setattr(self, name, new)
+
+	## Add a node.
+	#  @param m node transformation.
+	#  @param r cylinder radius.
+	#  @param h cylinder height.
+	#  @param c node color.
+	#  @param rd whether to create a rounded cylinder.
+	#  @param leaf whether the node is a flower.
+	def add(self, m, r, h, c, rd, leaf=False):
+		if self.count == len(self.radiusArray):
+			if self.sink is not None:
+				self.flush()
+			else:
+				self.reserve(1)
+		i = self.count
+		self.transformArray[i] = m
+		self.radiusArray[i] = r
+		self.lengthArray[i] = h
+		self.colorArray[i] = self.colorIndex(c)
+		self.roundedArray[i] = rd
+		self.leafArray[i] = leaf
+		self.count += 1
+
+	## Add many nodes at once.
+	#  @param transforms (N,4,4) node transformations.
+	#  @param radii cylinder radii.
+	#  @param lengths cylinder heights.
+	#  @param colorIndex indices of the node colors in the given palette.
+	#  @param palette colors indexed by colorIndex.
+	#  @param rounded whether to create rounded cylinders.
+	#  @param leaves whether the nodes are flowers.
+	def extend(self, transforms, radii, lengths, colorIndex, palette, rounded, leaves):
+		n = len(transforms)
+		self.reserve(n)
+		remap = np.array([self.colorIndex(c) for c in palette] or [0], dtype=np.int32)
+		i, j = self.count, self.count + n
+		self.transformArray[i:j] = transforms
+		self.radiusArray[i:j] = radii
+		self.lengthArray[i:j] = lengths
+		self.colorArray[i:j] = remap[np.asarray(colorIndex)]
+		self.roundedArray[i:j] = rounded
+		self.leafArray[i:j] = leaves
+		self.count = j
+		if self.sink is not None:
+			self.flush()
+
+	## Append the rows of another store.
+	def append(self, other):
+		self.extend(other.transforms(), other.radii(), other.lengths(), other.colors(), other.palette,
+					other.rounded(), other.leaves())
+
+	## Return a new store with the given rows, in the given order.
+	#  @param index indices of the rows.
+	def take(self, index):
+		index = np.asarray(index)
+		store = SegmentStore(capacity=len(index))
+		store.extend(self.transforms()[index], self.radii()[index], self.lengths()[index], self.colors()[index],
+					 self.palette, self.rounded()[index], self.leaves()[index])
+		return store
+
+	## Keep only the given rows, in the given order.
+	#  @param index indices of the rows to keep.
+	def compact(self, index):
+		index = np.asarray(index)
+		for name in ("transformArray", "radiusArray", "lengthArray", "colorArray", "roundedArray", "leafArray"):
+			array = getattr(self, name)
+			array[:len(index)] = array[:self.count][index]
+		self.count = len(index)
+
+	## Return the transforms of the rows in use.
+	def transforms(self):
+		return self.transformArray[:self.count]
+
+	## Return the radii of the rows in use.
+	def radii(self):
+		return self.radiusArray[:self.count]
+
+	## Return the heights of the rows in use.
+	def lengths(self):
+		return self.lengthArray[:self.count]
+
+	## Return the color indices of the rows in use.
+	def colors(self):
+		return self.colorArray[:self.count]
+
+	## Return the rounded flags of the rows in use.
+	def rounded(self):
+		return self.roundedArray[:self.count]
+
+	## Return the leaf flags of the rows in use.
+	def leaves(self):
+		return self.leafArray[:self.count]
+
+	## Return the number of bytes used by the arrays.
+	def nbytes(self):
+		return sum(getattr(self, name).nbytes for name in
+				   ("transformArray", "radiusArray", "lengthArray", "colorArray", "roundedArray", "leafArray"))
+
+	## Return the SolidPython object of a single row.
+	#  @param i row index.
+	#  @param fn number of fragments of the row, or None to use $fn.
+	def node(self, i, fn=None):
+		m = self.transformArray[i].tolist()
+		r = float(self.radiusArray[i])
+		h = float(self.lengthArray[i])
+		c = self.palette[self.colorArray[i]]
+		if self.leafArray[i]:
+			return multmatrix(m)(color(c)(flowerInstance(r, fn)))
+		if self.roundedArray[i]:
+			return color(c)(multmatrix(m)(sphere(r, segments=fn))(cylinder(r, h, segments=fn)))
+		return color(c)(multmatrix(m)(cylinder(r, h, segments=fn)))
+
+	## Return the stored nodes as SolidPython objects.
+	#  The flowers call the flower module, see ScadWriter.FLOWER_MODULE.
+	#  @param lod LevelOfDetail choosing the number of fragments of each node, or None to use $fn.
+	#  @return a union with the node list.
+	def toSolid(self, lod=None):
+		if lod is None:
+			return union()([self.node(i) for i in range(self.count)])
+		fragments = lod.fragments(self.radii())
+		return union()([self.node(i, int(fragments[i])) for i in range(self.count)])
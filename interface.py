@@ -11,9 +11,54 @@
 import sys
 import subprocess
 from BuildTree import BuildTree
+from Estimator import BudgetExceeded
+from Progress import Progress, BuildCancelled
+from PyQt5.QtCore import QThread, pyqtSignal
 from PyQt5.QtWidgets import (QWidget, QLabel, QLineEdit, QComboBox, QPushButton,
 							 QCheckBox, QTextEdit, QGridLayout, QApplication)
 
+## Builds a tree on a background thread, so that the window stays responsive.
+#  The progress of the build is sent to the interface through Qt signals, which are delivered on the UI thread.
+class BuildWorker(QThread):
+
+	## Emitted with the name and the value of each progress report.
+	progressed = pyqtSignal(str, 'qint64')
+	## Emitted with the path of the generated file.
+	built = pyqtSignal(str)
+	## Emitted with a message when the build fails or is cancelled.
+	failed = pyqtSignal(str)
+
+	## Constructor.
+	#  @param treeBuilder the BuildTree drawing the tree.
+	#  @param rule an LSysObj, or None to draw a recursive tree.
+	def __init__(self, treeBuilder, rule=None):
+		super().__init__()
+		self.treeBuilder = treeBuilder
+		self.rule = rule
+		self.progress = Progress(self.progressed.emit)
+
+	## Ask the build to stop at its next progress report.
+	def cancel(self):
+		self.progress.cancel()
+
+	## Draw the tree. Runs on the worker thread.
+	def run(self):
+		self.treeBuilder.setProgress(self.progress)
+		try:
+			if self.rule is None:
+				filepath = self.treeBuilder.draw(rec = True)
+			else:
+				filepath = self.treeBuilder.draw(rule = self.rule)
+		except (BudgetExceeded, BuildCancelled) as e:
+			self.failed.emit(str(e))
+			return
+		except Exception as e:
+			self.failed.emit("%s: %s" % (type(e).__name__, e))
+			return
+		finally:
+			self.treeBuilder.setProgress(None)
+		self.built.emit(filepath)
+
 
 class Example(QWidget):
 	
@@ -25,6 +70,10 @@ class Example(QWidget):
 		self.axisList = ["Orientation", "+X", "+Y", "+Z", "-X", "-Y", "-Z"]
 		self.diameterList = ["Base Diameter - Default 6", "6", "20", "35", "45", "60", "75"]
 		self.func = self.treeBuilder.rules.kochCurve1()
+		## BuildWorker of the build in progress, or None.
+		self.worker = None
+		## OpenSCAD processes launched to show the models.
+		self.viewers = []
 		self.initUI()
 		
 	## Initialize the components found in the GUI.
@@ -59,6 +108,12 @@ class Example(QWidget):
 		
 		spheres = QCheckBox('Add Spheres', self)
 		spheres.stateChanged.connect(self.setSpheres)
+		merge = QCheckBox('Merge Collinear Segments', self)
+		merge.stateChanged.connect(self.setMerge)
+		cache = QCheckBox('Cache Models', self)
+		cache.stateChanged.connect(self.setCache)
+		pipeline = QCheckBox('Reuse Unchanged Stages', self)
+		pipeline.stateChanged.connect(self.setPipeline)
 		base = QCheckBox('Add Base To Model', self)
 		base.stateChanged.connect(self.setBase)
 		debug = QCheckBox('Set Debug', self)
@@ -74,13 +129,21 @@ class Example(QWidget):
 		self.ownRules = QLineEdit()
 		closeLabel = QLabel('---------------------------------------')
 
-		build = QPushButton('Build Tree!', self)
-		build.clicked.connect(self.on_click)
+		self.build = QPushButton('Build Tree!', self)
+		self.build.clicked.connect(self.on_click)
+		self.cancel = QPushButton('Cancel', self)
+		self.cancel.clicked.connect(self.on_cancel)
+		self.cancel.setEnabled(False)
+		self.status = QLabel('', self)
 
 		grid = QGridLayout()
 		grid.setSpacing(10)
 		
-		interfaceComponents = [rulesTitle, rules, pre_Rules, combo, options, stochastic, multiple, orientation, spheres, base, diameter, debug, rec, own_Rules, parLabels, self.ownAngle, self.ownNum, self.ownSentence, self.ownRules, closeLabel, build]
+		## Widgets changing the options of treeBuilder, disabled while a build reads them.
+		self.options = [combo, stochastic, multiple, orientation, spheres, merge, cache, pipeline, base, diameter, debug, rec,
+						self.ownAngle, self.ownNum, self.ownSentence, self.ownRules]
+
+		interfaceComponents = [rulesTitle, rules, pre_Rules, combo, options, stochastic, multiple, orientation, spheres, merge, cache, pipeline, base, diameter, debug, rec, own_Rules, parLabels, self.ownAngle, self.ownNum, self.ownSentence, self.ownRules, closeLabel, self.build, self.cancel, self.status]
 
 		i = 0
 		for component in interfaceComponents:
@@ -132,20 +195,61 @@ class Example(QWidget):
 			return self.treeBuilder.rules.createCustomRule(angle, sentence, num, d)
 
 	## When the 'Build Tree" button is pressed, a tree model is generated according to the
-	#  selected options in the interface.
+	#  selected options in the interface. The model is built by a BuildWorker, and opened in OpenSCAD when it is done.
 	def on_click(self):
+		if self.worker is not None:
+			return
 		rules = self.func
 		
 		if self.buildRec:
-			self.treeBuilder.draw(rec = True)
-			subprocess.call(["openscad", "lSystemModel" + str(self.treeBuilder.filepathCounter)+ ".scad"])
-			return
-		
-		if self.buildOwnTree() is not None:
+			rules = None
+		elif self.buildOwnTree() is not None:
 			rules = self.buildOwnTree()
 
-		self.treeBuilder.draw(rule = rules)
-		subprocess.call(["openscad", "lSystemModel" + str(self.treeBuilder.filepathCounter)+ ".scad"])
+		self.worker = BuildWorker(self.treeBuilder, rules)
+		self.worker.progressed.connect(self.onProgress)
+		self.worker.built.connect(self.onBuilt)
+		self.worker.failed.connect(self.onFailed)
+		self.worker.finished.connect(self.onFinished)
+		self.setOptionsEnabled(False)
+		self.status.setText('Building...')
+		self.worker.start()
+
+	## Stop the build in progress at its next progress report.
+	def on_cancel(self):
+		if self.worker is not None:
+			self.worker.cancel()
+			self.status.setText('Cancelling...')
+
+	## Show the progress reports of the build.
+	def onProgress(self, name, value):
+		values = self.worker.progress.values if self.worker is not None else {name: value}
+		self.status.setText(", ".join("%s: %d" % (key, values[key]) for key in ("generations", "segments", "bytes") if key in values))
+
+	## Open the generated file in OpenSCAD without waiting for it to close.
+	def onBuilt(self, filepath):
+		self.status.setText('Built ' + filepath)
+		self.viewers = [p for p in self.viewers if p.poll() is None]
+		try:
+			self.viewers.append(subprocess.Popen(["openscad", filepath]))
+		except OSError as e:
+			print(e)
+
+	## Show why the build stopped.
+	def onFailed(self, message):
+		print(message)
+		self.status.setText(message)
+
+	## Allow a new build once the worker thread is done.
+	def onFinished(self):
+		self.worker = None
+		self.setOptionsEnabled(True)
+
+	## Enable the Build button and the option widgets, and disable the Cancel button, or the opposite.
+	def setOptionsEnabled(self, state):
+		for widget in self.options + [self.build]:
+			widget.setEnabled(state)
+		self.cancel.setEnabled(not state)
 
 	## Determine whether to use stochastic rules to generate the models.
 	def setStochastic(self, state):
@@ -159,6 +263,18 @@ class Example(QWidget):
 	def setSpheres(self, state):
 		self.treeBuilder.useSpheres(state)
 
+	## Sets treeBuilder to fuse consecutive collinear cylinders according to the 'state' param.
+	def setMerge(self, state):
+		self.treeBuilder.useMerge(state)
+
+	## Sets treeBuilder to reuse the models it built before according to the 'state' param.
+	def setCache(self, state):
+		self.treeBuilder.useCache(bool(state))
+
+	## Sets treeBuilder to rerun only the stages whose parameters changed according to the 'state' param.
+	def setPipeline(self, state):
+		self.treeBuilder.usePipeline(bool(state))
+
 	## Sets treeBuilder to print the debug log according to the 'state' param.
 	def setDebug(self, state):
 		self.treeBuilder.printDebug(state)
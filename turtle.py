@@ -41,6 +41,8 @@ import random
 from solid import *
 from solid.utils import *
 
+from ScadWriter import FLOWER_MODULE, flowerInstance
+
 SEGMENTS = 30
 
 ## Rotate the given vector about the x axis.
@@ -124,9 +126,10 @@ class turtle(object):
 	#  @param r Cylinder radius.
 	#  @param h Cylinder height.
 	#  @param t When False, use yaw, pitch and roll.
+	#  @param store SegmentStore to write the nodes into, instead of creating openscad primitives.
 	#  @see https://en.wikibooks.org/wiki/OpenSCAD_User_Manual/The_OpenSCAD_Language#cylinder
 	#  <br>
-	def __init__(self, r=2, h=10, t=False):
+	def __init__(self, r=2, h=10, t=False, store=None, rng=None):
 		## Cylinder radius.
 		self.r = r
 
@@ -141,6 +144,10 @@ class turtle(object):
 		self.nodecount = 0
 		## Color for the leaves
 		self.leafCol = None
+		## Array-backed node storage, or None to keep a list of openscad primitives.
+		self.store = store
+		## Random number generator choosing the leaf color, e.g. a random.Random.
+		self.rng = rng if rng is not None else random
 
 		if not t:	
 			self.mode ("standard")
@@ -154,12 +161,18 @@ class turtle(object):
 	def setDebug(self, state=False):
 		turtle.__toDebug__ = state
 
+	## Return whether debugging is on.
+	def isDebug(self):
+		return turtle.__toDebug__
+
 	## Delete the turtle’s drawings from the screen, 
 	#  re-center the turtle and set variables to the default values.
 	#
 	def reset(self):
 		## A list with openscad primitives.
 		self.nodes = []
+		if self.store is not None:
+			self.store.clear()
 
 		# Set default position and orientation.
 		self.home()
@@ -471,8 +484,10 @@ class turtle(object):
 			h = self.h
 		if rd is None:
 			rd = self.round
-		
-		if rd:
+
+		if self.store is not None:
+			self.store.add(m, r, h, c, rd)
+		elif rd:
 			self.nodes.append(
 				(color(c))
 				(multmatrix(m)
@@ -511,8 +526,16 @@ class turtle(object):
 			h = self.h
 		if rd is None:
 			rd = self.round
-		
-		if rd:
+
+		if self.store is not None:
+			t = self.position()
+			if isinstance(ang, list):
+				rot = matrix.rotateXYZ(ang)
+			else:
+				rot = matrix.rotate(ang, axis[0], axis[1], axis[2])
+			m = matrix.dot(matrix.translate(t[0],t[1],t[2]), rot)
+			self.store.add(m, r, h, c, rd)
+		elif rd:
 			self.nodes.append(
 				(translate(self.position()))
 				(rotate(a = ang, v = axis)
@@ -536,7 +559,7 @@ class turtle(object):
 	def addLeaf(self, c=None, r=None):
 		if c is None and self.leafCol is None:
 			cols = [colors["medium orchid"], colors["magenta"], colors["pastel pink"], colors["orange red"], colors["cyan"]]
-			rand = random.randint(0, len(cols) - 1)
+			rand = self.rng.randint(0, len(cols) - 1)
 			c = cols[rand]
 			self.leafCol = c
 		
@@ -550,19 +573,15 @@ class turtle(object):
 		m = self.rotMatrix
 		m = matrix.dot(matrix.translate(t[0],t[1],t[2]), m).tolist()
 
+		if self.store is not None:
+			self.store.add(m, r, 0, c, False, leaf=True)
+			return
 
-		flower = union()(
-						 translate([0, 0.5, 0])(sphere(r)),
-						 translate([0, -0.5, 0])(sphere(r)),
-						 translate([0, 0, 0.5])(sphere(r)),
-						 translate([0, 0, -0.5])(sphere(r))
-
-						 )
-		
+		# Every flower calls the same module, which the scad file defines once.
 		self.nodes.append(
 				(multmatrix(m)
 					(color(c)
-						(flower)
+						(flowerInstance(r))
 					)
 				)
 		)
@@ -649,6 +668,8 @@ class turtle(object):
 	#  @return a union with the node list.
 	#
 	def getNodes(self):
+		if self.store is not None:
+			return self.store.toSolid()
 		return union()(self.nodes)
 
 ## Draw a sphere. 
@@ -1087,7 +1108,7 @@ def main(argv=None):
 
 	lTree = funcDict[proc]()
 
-	scad_render_to_file(lTree, file_header='$fn = %s;' % SEGMENTS, include_orig_code=True)
+	scad_render_to_file(lTree, file_header='$fn = %s;\n\n%s' % (SEGMENTS, FLOWER_MODULE), include_orig_code=True)
 
 if __name__ == '__main__':
 	sys.exit(main())